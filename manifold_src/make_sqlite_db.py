@@ -3,6 +3,15 @@ import sqlite3
 import binascii
 import re
 import csv
+import hashlib
+import json
+import itertools
+import glob
+import shutil
+import struct
+import math
+import numbers
+from array import array
 
 """
 This file contains the functions used to pull the data
@@ -31,86 +40,970 @@ schema_types = {
     'perm':'int',
     'cuspedtriangulation':'text',
     'solids': 'int',
-    'isAugKTG': 'int'
+    'isAugKTG': 'int',
+    'crossings': 'int',
+    'alternating': 'int',
+    'components': 'int',
+    'isosig': 'text',
+    'DT_key': 'text',
+    'DT_ints': 'blob',
 }
 
+# With SNAPPY_15_KNOTS_CANONICAL_ISOSIGS=1 in the environment, tables
+# with a triangulation column also get an isosig column, with an index,
+# so that a triangulation can be looked up exactly with one probe.  The
+# column holds the canonical undecorated isosig which snappy computes
+# for each triangulation, i.e. M.triangulation_isosig(decorated=False).
+# The stored isosigs were made by older software and are not canonical
+# in that sense, so the column is not built otherwise.  Canonical
+# isosigs take a few ms per row, i.e. several CPU minutes for the
+# census, so they are computed by a pool of processes, and snappy must
+# be installed.
+canonical_isosigs = os.environ.get(
+    'SNAPPY_15_KNOTS_CANONICAL_ISOSIGS', '0') != '0'
 
-def make_table(connection, tablename, csv_files, name_index=True):
+def undecorated_isosig(triangulation):
+    return triangulation.split('(')[0].split('_')[0]
+
+def canonical_isosig(triangulation):
+    from snappy import Triangulation
+    T = Triangulation(triangulation.split('(')[0])
+    return T.triangulation_isosig(decorated=False)
+
+def isosig_mode():
+    """
+    'canonical' if canonical_isosigs is set, otherwise 'none'; recorded
+    in the metadata as 'isosigs'.
+    """
+    if canonical_isosigs:
+        try:
+            import snappy
+        except ImportError:
+            raise RuntimeError('SNAPPY_15_KNOTS_CANONICAL_ISOSIGS needs '
+                               'snappy to compute the isosigs')
+        return 'canonical'
+    return 'none'
+
+# Tables with a DT column also get a DT_key column, with an index, so
+# that a link can be found from its DT code.  The DT codes are stored
+# in the alphabetical encoding of spherogram, e.g. 'cacbca.001', where
+# the letters after the header are the even entries of the DT code,
+# upper case for negative ones, and the digits after the '.' are the
+# flips which choose the planar embedding.  A DT code depends on how
+# the diagram is traversed, and spherogram generally traverses a
+# diagram differently from the tables, so the key is the least DT
+# code, without flips, over all traversals of the diagram and of its
+# mirror image; the tables list links only up to mirror image.  DT_key
+# also accepts the other forms of DT code, for the lookups made by
+# database.py, which imports it from here.
+def link_DT_key(code):
+    """
+    The least of the alphabetical DT codes, without flips, of all
+    traversals of a link diagram and of its mirror image, i.e. over
+    all orders of the components and all starting points and
+    directions on each of them which give a DT code.
+    """
+    header = 2 + ord(code[1]) - 96
+    lengths = [2 * (ord(letter) - 96) for letter in code[2:header]]
+    body = code[header:]
+    size = 2 * len(body)
+    # For each position along the link, the position of the other
+    # strand at its crossing, and whether this strand is the over
+    # strand in the sense of the even entry of a negative pair.  The
+    # positions of each component are consecutive.
+    partner, over = [0] * size, [False] * size
+    for i, letter in enumerate(body):
+        even = 2 * (ord(letter.lower()) - 96) - 1
+        partner[2 * i], partner[even] = even, 2 * i
+        over[even], over[2 * i] = letter.isupper(), letter.islower()
+    component, first = [], []
+    for c, length in enumerate(lengths):
+        first.append(len(component))
+        component += [c] * length
+    # The least codes list the components by length, so the lengths of
+    # the slots which the components take in the traversal are known;
+    # which component takes a slot, and where it starts, is chosen
+    # when it is first needed.  A candidate is the mirror flag, the
+    # component in each slot and the (offset, start, direction) of each
+    # component.  The least first entry is upper case, which fixes the
+    # mirror flag of each traversal at the first entry.  A traversal gives a DT code, with an odd and an even
+    # label at each crossing, if and only if the starting points of all
+    # components are at an even distance from those of the code, or
+    # all at an odd one.
+    slot_lengths = sorted(lengths)
+    offsets = [sum(slot_lengths[:q]) for q in range(len(lengths))]
+    slot_of = [q for q, length in enumerate(slot_lengths)
+               for i in range(length)]
+    def place(candidate, c, q, start, direction):
+        mirror, slots, placements = candidate
+        return (mirror, slots[:q] + (c,) + slots[q + 1:],
+                placements[:c] + ((offsets[q], start, direction),)
+                + placements[c + 1:])
+    candidates = [(None, (None,) * len(lengths), (None,) * len(lengths))]
+    entries = []
+    # Keep the traversals giving the least entries, one entry at a
+    # time; the entry for the label k + 1 is the label of its partner,
+    # counting from 0 here.  The new candidates are only made for the
+    # moves, i.e. placements of the component of the slot of k and of
+    # the partner, which give the least entry.
+    for k in range(0, size, 2):
+        q = slot_of[k]
+        values = []
+        for candidate in candidates:
+            mirror, slots, placements = candidate
+            if slots[q] is None:
+                # All starting points of the same parity as those of
+                # the components which are already placed, if any.
+                length = slot_lengths[q]
+                starts = range(length)
+                for placement in placements:
+                    if placement is not None:
+                        starts = range(placement[1] % 2, length, 2)
+                        break
+                moves = [(c, start, direction)
+                         for c, placement in enumerate(placements)
+                         if placement is None and lengths[c] == length
+                         for start in starts for direction in (1, -1)]
+            else:
+                c = slots[q]
+                moves = [(c,) + placements[c][1:]]
+            for move in moves:
+                c, start, direction = move
+                other = partner[first[c] + (
+                    start + direction * (k - offsets[q])) % lengths[c]]
+                case = 64 if mirror is None or over[other] != mirror else 96
+                d = component[other]
+                if d == c or placements[d] is not None:
+                    if d != c:
+                        offset, start, direction = placements[d]
+                    else:
+                        offset = offsets[q]
+                    value = offset + (other - first[d] - start) * direction % (
+                        lengths[d])
+                    values.append((value // 2 + 1 + case, candidate, move,
+                                   None, other))
+                    continue
+                # Only the placements of the partner's component which
+                # give it the least label of a free slot, one more than
+                # its offset, can give the least entry.
+                rest, length = other - first[d], lengths[d]
+                for r, slot in enumerate(slots):
+                    if slot is None and r != q and slot_lengths[r] == length:
+                        value = offsets[r] // 2 + 1 + case
+                        values.append((value, candidate, move,
+                                       (d, r, (rest - 1) % length, 1), other))
+                        values.append((value, candidate, move,
+                                       (d, r, (rest + 1) % length, -1), other))
+        least = min(value[0] for value in values)
+        candidates = []
+        for value, candidate, move, partner_move, other in values:
+            if value != least:
+                continue
+            if candidate[1][q] is None:
+                candidate = place(candidate, move[0], q, *move[1:])
+            if partner_move is not None:
+                candidate = place(candidate, *partner_move)
+            if candidate[0] is None:
+                candidate = (not over[other],) + candidate[1:]
+            candidates.append(candidate)
+        entries.append(least)
+    return code[:2] + ''.join(
+        chr(96 + length // 2) for length in slot_lengths) + ''.join(
+            chr(entry) for entry in entries)
+
+alpha_DT = re.compile(r'(?:DT[:\[]?)?([a-zA-Z]+)(?:\.[01]*)?\]?$')
+
+def DT_key(DT):
+    """
+    The key under which a DT code is indexed in the DT_key column,
+    which is the same for all traversals of the diagram and for its
+    mirror image, see link_DT_key.  The DT code can be given in
+    the alphabetical form of the tables, with or without flips or a
+    header, as a numerical DT code such as [(4, 6, 2)] or (4, 6, 2), or
+    as an object with a DT_code method such as a spherogram Link.
+
+    >>> DT_key('cacbca.001'), DT_key('DT:cacbca'), DT_key([(-4, -6, -2)])
+    ('cacBCA', 'cacBCA', 'cacBCA')
+    >>> DT_key([(6, 8), (2, 10, 4)]), DT_key([(-10, -8), (-4, -2, -6)])
+    ('ebbcCDAEB', 'ebbcCDAEB')
+
+    A ValueError is raised for anything else, including DT codes with
+    more than 26 crossings, which the alphabetical form cannot hold.
+    """
+    given = DT
+    if hasattr(DT, 'DT_code'):
+        DT = DT.DT_code()
+    if isinstance(DT, str):
+        match = alpha_DT.match(DT.strip())
+        if match:
+            code = match.group(1)
+        else:
+            DT = [[int(x) for x in re.findall('-?[0-9]+', component)]
+                  for component in re.findall(r'\(([^()]*)\)', DT)]
+    if not isinstance(DT, str):
+        components = ([list(DT)] if DT and isinstance(DT[0], numbers.Integral)
+                      else list(DT))
+        entries = [entry for component in components for entry in component]
+        sizes = [len(entries), len(components)] + [
+            len(component) for component in components]
+        if (not entries or max(sizes) > 26
+            or any(entry % 2 or not 0 < abs(entry) <= 52 for entry in entries)):
+            raise ValueError('%r is not a DT code with at most 26 crossings.'
+                             % (given,))
+        code = ''.join(chr(96 + size) for size in sizes) + ''.join(
+            chr(96 + entry // 2) if entry > 0 else chr(64 - entry // 2)
+            for entry in entries)
+    header = 2 + ord(code[1]) - 96 if len(code) > 1 else 0
+    if (not code[:header].islower() or sorted(
+            ord(letter.lower()) - 96 for letter in code[header:]) !=
+        list(range(1, ord(code[0]) - 95)) or
+        sum(ord(letter) - 96 for letter in code[2:header]) != len(
+            code) - header):
+        raise ValueError('%r is not a DT code.' % (given,))
+    return link_DT_key(code)
+
+# Tables with a DT column also get a DT_ints column holding the
+# numerical DT code, so that it can be read without decoding the
+# letters: the number of components, the number of entries of each
+# component, one byte each, and then the entries as signed bytes.  So
+# 'cacbca.001', i.e. [(4, 6, 2)], is stored as 01 03 04 06 02.  The
+# flips are not included.  DT codes with more than 63 crossings or 255
+# components, which do not fit, are stored as null.
+def pack_DT_ints(DT):
+    code = DT.split('.')[0]
+    num_components = ord(code[1]) - 96
+    lengths = [ord(letter) - 96 for letter in code[2:2 + num_components]]
+    entries = [2 * (ord(letter) - 96) if letter.islower()
+               else -2 * (ord(letter) - 64)
+               for letter in code[2 + num_components:]]
+    if len(entries) > 63:
+        return None
+    return bytes([num_components] + lengths) + array('b', entries).tobytes()
+
+def unpack_DT_ints(value):
+    if value is None:
+        return None
+    view = memoryview(value)
+    num_components = view[0]
+    entries = view[1 + num_components:].cast('b')
+    code, start = [], 0
+    for length in view[1:1 + num_components]:
+        code.append(tuple(entries[start:start + length]))
+        start += length
+    return code
+
+# With SNAPPY_15_KNOTS_COMPACT=1 in the environment, the triangulation,
+# isosig and DT columns are stored as blobs instead of text.  Isosigs
+# use 64 letters, so an isosig packs into 6 bits per letter: translated
+# to the base64 alphabet it is decoded by base64.  The blob of a
+# triangulation such as 'cPcbbbqtt_baeb' is the number of letters of
+# padding and the position of the '_', one byte each, followed by the
+# packed letters.  The letters of an alphabetical DT code are packed
+# the same way and its flips, the digits after the '.', one bit each
+# from the high bit of the first byte; the blob is the padding, the
+# number of flips, the letters and then the flips.  Values of any other
+# form are stored as text, and the tables decode blobs with the unpack
+# functions below when they read them, so a database may mix the two.
+# This makes the isosig columns about 20% smaller and the DT column 40%
+# smaller.
+compact_storage = os.environ.get('SNAPPY_15_KNOTS_COMPACT', '0') != '0'
+
+isosig_letters = (b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+                  b'0123456789+-')
+base64_letters = (b'ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+                  b'0123456789+/')
+to_base64 = bytes.maketrans(isosig_letters, base64_letters)
+from_base64 = bytes.maketrans(base64_letters, isosig_letters)
+packable_isosig = re.compile(r'[a-zA-Z0-9+-]+(_[a-zA-Z0-9+-]+)?$')
+packable_DT = re.compile(r'[a-zA-Z]+\.[01]+$')
+
+def pack_letters(letters):
+    padding = -len(letters) % 4
+    return padding, binascii.a2b_base64(
+        (letters + 'a' * padding).encode('ascii').translate(to_base64))
+
+def unpack_letters(data, padding):
+    letters = binascii.b2a_base64(data, newline=False).translate(
+        from_base64).decode('ascii')
+    return letters[:len(letters) - padding]
+
+def pack_isosig(triangulation):
+    if not packable_isosig.match(triangulation) or len(triangulation) > 255:
+        return triangulation
+    split = triangulation.find('_') + 1
+    padding, data = pack_letters(triangulation.replace('_', ''))
+    return struct.pack('BB', padding, split) + data
+
+def unpack_isosig(value):
+    if not isinstance(value, bytes):
+        return value
+    padding, split = value[0], value[1]
+    letters = unpack_letters(value[2:], padding)
+    if split:
+        return letters[:split - 1] + '_' + letters[split - 1:]
+    return letters
+
+def pack_DT(DT):
+    if not packable_DT.match(DT) or len(DT) > 255:
+        return DT
+    letters, flips = DT.split('.')
+    padding, data = pack_letters(letters)
+    num_bytes = (len(flips) + 7) // 8
+    flip_bytes = int(flips.ljust(8 * num_bytes, '0'), 2).to_bytes(
+        num_bytes, 'big')
+    return struct.pack('BB', padding, len(flips)) + data + flip_bytes
+
+byte_bits = ['{:08b}'.format(byte) for byte in range(256)]
+
+def unpack_DT(value):
+    if not isinstance(value, bytes):
+        return value
+    padding, num_flips = value[0], value[1]
+    end = len(value) - (num_flips + 7) // 8
+    flips = ''.join([byte_bits[byte] for byte in value[end:]])
+    return unpack_letters(value[2:end], padding) + '.' + flips[:num_flips]
+
+def storage_mode():
+    """
+    'compact' or 'text'; recorded in the metadata as 'storage'.
+    """
+    return 'compact' if compact_storage else 'text'
+
+# For tables of links with Hoste-Thistlethwaite names such as K15n1234
+# or L14a56, these columns are computed from the name at build time so
+# that the filters on them can use an index instead of a LIKE scan.
+# The name does not say how many components a link has, but its
+# exterior has one cusp per component.
+link_columns = ['crossings', 'alternating', 'components']
+HT_name = re.compile(r'([KL])([0-9]+)([an])([0-9]+)$')
+
+def table_columns(columns, with_link_columns=False):
+    """
+    The columns of a table loaded from csv files with the given
+    columns, including those computed at build time.
+    """
+    result = list(columns)
+    if 'triangulation' in columns and isosig_mode() == 'canonical':
+        result.append('isosig')
+    if 'DT' in columns:
+        result += ['DT_key', 'DT_ints']
+    if with_link_columns:
+        result += link_columns
+    return result
+
+def link_data(name, cusps):
+    """
+    The values of the link_columns for a link with the given name.
+    """
+    match = HT_name.match(name)
+    if match is None:
+        return [None, None, None]
+    kind, crossings, flavor, index = match.groups()
+    components = 1 if kind == 'K' else int(cusps)
+    return [int(crossings), int(flavor == 'a'), components]
+
+
+# Settings used only while building.  Without a journal a failed
+# statement or a crash can leave the database corrupt, so these are
+# only safe because the build works on a copy of the database, which
+# replaces it once the build has finished; see the end of this file.
+build_pragmas = [
+    'pragma journal_mode = off',
+    'pragma synchronous = off',
+    'pragma cache_size = -262144',  # negative means KiB, so 256MB
+    'pragma temp_store = memory',
+]
+
+def configure_for_build(connection):
+    """
+    Apply the build-time pragmas to a connection.
+    """
+    for pragma in build_pragmas:
+        connection.execute(pragma)
+
+def csv_rows(csv_path, columns):
+    """
+    Generator yielding the data rows of a csv file, one list at a time,
+    with the string 'None' replaced by a real None so that it is stored
+    as Null.  The header must match the given columns.
+    """
+    with open(csv_path, newline='') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        assert columns == next(csv_reader)
+        for row in csv_reader:
+            yield [None if data == 'None' else data for data in row]
+
+def chunks(iterable, size):
+    """
+    Split an iterable into lists of at most the given size.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+def csv_columns(csv_file):
+    """
+    The column names from the first line of a csv file.
+    """
+    with open(os.path.join(csv_dir, csv_file), newline='') as file:
+        return next(csv.reader(file))
+
+def file_hash(csv_file):
+    """
+    The sha1 hex digest of the contents of a csv file.  Unlike the
+    modification time, this survives a git checkout.
+    """
+    sha1 = hashlib.sha1()
+    with open(os.path.join(csv_dir, csv_file), 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+# The build manifest records, for each csv file, the table it was
+# loaded into, the hash of its contents and the range of ids of the
+# rows it contributed.  It is what allows update_table to redo only
+# the parts of a table whose source has changed.
+manifest_schema = """create table if not exists build_manifest (
+    csv_file text primary key,
+    tablename text,
+    position int,
+    hash text,
+    first_id int,
+    last_id int)"""
+
+# Bump this whenever the layout of the tables written by this module
+# changes, so that existing databases get rebuilt rather than updated.
+schema_version = 6
+
+# Summary data about each table, so that the table classes can find
+# their lengths and volume bounds without aggregating over the whole
+# table each time snappy is imported.  The categories table holds the
+# same data for each combination of the link_columns.
+metadata_schema = """create table if not exists metadata (
+    tablename text,
+    key text,
+    value,
+    primary key (tablename, key))"""
+
+categories_schema = """create table if not exists categories (
+    tablename text,
+    crossings int,
+    alternating int,
+    components int,
+    rows int,
+    min_id int,
+    max_id int,
+    min_volume real,
+    max_volume real)"""
+
+# The rows of a table with link_columns are in order of name within
+# each prefix such as K15n, so that a name can be resolved to its id
+# by arithmetic: each row of name_offsets is a run of rows whose names
+# are prefix + first_index, ..., prefix + last_index and whose ids are
+# consecutive, starting at first_id.
+name_offsets_schema = """create table if not exists name_offsets (
+    tablename text,
+    prefix text,
+    first_index int,
+    last_index int,
+    first_id int,
+    primary key (tablename, prefix, first_index))"""
+
+def name_runs(rows):
+    """
+    Generator splitting (id, name) rows, in the order of the ids, into
+    the runs of the name_offsets table; names that are not HT names
+    are skipped, and so are left to the name index.
+    """
+    run = None
+    for id, name in rows:
+        match = HT_name.match(name)
+        if match is None:
+            continue
+        kind, crossings, flavor, index = match.groups()
+        prefix, index = kind + crossings + flavor, int(index)
+        if (run is not None and prefix == run[0] and index == run[2] + 1
+            and id == run[3] + index - run[1]):
+            run[2] = index
+            continue
+        if run is not None:
+            yield tuple(run)
+        run = [prefix, index, index, id]
+    if run is not None:
+        yield tuple(run)
+
+def read_metadata(connection, tablename):
+    """
+    Return the metadata of a table as a dictionary.
+    """
+    connection.execute(metadata_schema)
+    cursor = connection.execute(
+        'select key, value from metadata where tablename=?', (tablename,))
+    return dict(cursor.fetchall())
+
+def write_metadata(connection, tablename, with_link_columns=False):
+    """
+    Record the schema version, the number of rows, the range of
+    volumes and the csv hashes of a table in the metadata table and,
+    for tables with link_columns, the same data per category in the
+    categories table and the runs of names in the name_offsets table.
+    """
+    connection.execute(metadata_schema)
+    connection.execute(categories_schema)
+    connection.execute(name_offsets_schema)
+    for table in ['metadata', 'categories', 'name_offsets']:
+        connection.execute('delete from %s where tablename=?' % table,
+                           (tablename,))
+    rows, min_volume, max_volume = connection.execute(
+        'select count(*), min(volume), max(volume) from %s' % tablename
+        ).fetchone()
+    sources = [[csv_file, hash] for csv_file, hash, first_id, last_id
+               in read_manifest(connection, tablename)]
+    values = {'schema_version': schema_version,
+              'isosigs': isosig_mode(),
+              'storage': storage_mode(),
+              'rows': rows,
+              'min_volume': min_volume,
+              'max_volume': max_volume,
+              'sources': json.dumps(sources)}
+    connection.executemany(
+        'insert into metadata values (?, ?, ?)',
+        [(tablename, key, value) for key, value in values.items()])
+    if with_link_columns:
+        connection.execute(
+            'insert into categories select ?, %s, count(*), min(id), '
+            'max(id), min(volume), max(volume) from %s group by %s' % (
+                ', '.join(link_columns), tablename, ', '.join(link_columns)),
+            (tablename,))
+        rows = connection.execute(
+            'select id, name from %s order by id' % tablename).fetchall()
+        connection.executemany(
+            'insert into name_offsets values (?, ?, ?, ?, ?)',
+            [(tablename,) + run for run in name_runs(rows)])
+    connection.commit()
+
+# With SNAPPY_15_KNOTS_ARRAYS=1 in the environment, which needs NumPy,
+# the id, the name and each numeric column of a table are also written
+# to .npy files next to the database, for to_arrays.
+write_npy_arrays = os.environ.get('SNAPPY_15_KNOTS_ARRAYS', '0') != '0'
+
+def array_path(tablename, column):
+    return '%s.%s.npy' % (tablename, column)
+
+def column_array(column, type, values):
+    """
+    The NumPy array of the values of a column, as written to its .npy
+    file: ASCII bytes for the names, float64 for a real column, with
+    nan for null, and the narrowest of int8, int16, int32 and int64
+    which holds an integer column, with -1 for null.
+    """
+    import numpy
+    if column == 'name':
+        return numpy.array([value.encode('ascii') for value in values],
+                           dtype=bytes)
+    if type == 'real':
+        return numpy.array(values, dtype=numpy.float64)
+    values = [-1 if value is None else value for value in values]
+    low, high = min(values + [-1]), max(values + [-1])
+    for dtype in (numpy.int8, numpy.int16, numpy.int32, numpy.int64):
+        info = numpy.iinfo(dtype)
+        if info.min <= low and high <= info.max:
+            return numpy.array(values, dtype=dtype)
+
+def write_arrays(connection, tablename):
+    """
+    Write the id, the name and each numeric column of a table to .npy
+    files next to the database, one array per column, all in the order
+    of the ids, so that the table classes can memory-map them; see
+    column_array.  This is only done with write_npy_arrays; otherwise
+    any old .npy files of the table are removed so that they cannot go
+    stale, and the table classes read from the database instead.
+    """
+    if not write_npy_arrays:
+        for path in glob.glob(array_path(tablename, '*')):
+            os.remove(path)
+        return
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError('SNAPPY_15_KNOTS_ARRAYS needs NumPy to write '
+                           'the .npy files')
+    types = [(row[1], row[2].lower()) for row in connection.execute(
+        "pragma table_info('%s')" % tablename)]
+    for column, type in types:
+        if column != 'name' and type not in ('integer', 'int', 'real'):
+            continue
+        values = [row[0] for row in connection.execute(
+            'select %s from %s order by id' % (column, tablename))]
+        numpy.save(array_path(tablename, column),
+                   column_array(column, type, values))
+
+def bloom_path(tablename, column):
+    return '%s.%s.bloom' % (tablename, column)
+
+# A Bloom filter file is a header, packed as bloom_header, holding
+# bloom_magic, the number of bits and the number of hash functions,
+# followed by the bits.  The k bits of a key are found by double
+# hashing the md5 digest of the key; database.py must agree.
+bloom_magic = b'SNBLOOM1'
+bloom_header = '<8sQI'
+
+def bloom_bits(key, num_bits, num_hashes):
+    h1, h2 = struct.unpack('<QQ', hashlib.md5(key.encode('utf-8')).digest())
+    h2 |= 1
+    return [(h1 + i * h2) % num_bits for i in range(num_hashes)]
+
+def write_bloom_filter(connection, tablename, column='hash',
+                       false_positive_rate=0.01):
+    """
+    Write a Bloom filter of the values of a column next to the
+    database, sized for the given false positive rate, so that the
+    table classes can tell that a value is not in the table without a
+    query.  The expected false positive rate is recorded in the
+    metadata table.
+    """
+    values = [row[0] for row in connection.execute(
+        'select distinct %s from %s where %s is not null' % (
+            column, tablename, column))]
+    n = max(len(values), 1)
+    num_bits = int(math.ceil(-n * math.log(false_positive_rate) /
+                             math.log(2) ** 2))
+    num_bits = 8 * ((num_bits + 7) // 8)
+    num_hashes = max(1, int(round(num_bits / n * math.log(2))))
+    bits = bytearray(num_bits // 8)
+    for value in values:
+        for bit in bloom_bits(value, num_bits, num_hashes):
+            bits[bit >> 3] |= 1 << (bit & 7)
+    with open(bloom_path(tablename, column), 'wb') as output:
+        output.write(struct.pack(bloom_header, bloom_magic, num_bits,
+                                 num_hashes))
+        output.write(bits)
+    expected = (1 - math.exp(-num_hashes * n / num_bits)) ** num_hashes
+    connection.execute(
+        'insert or replace into metadata values (?, ?, ?)',
+        (tablename, '%s_bloom_false_positive_rate' % column, expected))
+    connection.commit()
+    print('wrote a Bloom filter of %d %s values of %s, %d bytes, '
+          'false positive rate %.4f' % (len(values), column, tablename,
+                                        len(bits), expected))
+
+def read_manifest(connection, tablename):
+    """
+    Return the list of manifest rows (csv_file, hash, first_id, last_id)
+    for the given table, in the order in which the files were loaded.
+    """
+    connection.execute(manifest_schema)
+    cursor = connection.execute(
+        'select csv_file, hash, first_id, last_id from build_manifest '
+        'where tablename=? order by position', (tablename,))
+    return cursor.fetchall()
+
+def record_in_manifest(connection, tablename, position, csv_file, hash,
+                       first_id, last_id):
+    connection.execute(
+        'insert or replace into build_manifest values (?, ?, ?, ?, ?, ?)',
+        (csv_file, tablename, position, hash, first_id, last_id))
+
+def count_csv_rows(csv_file):
+    """
+    The number of data rows in a csv file.
+    """
+    with open(os.path.join(csv_dir, csv_file), newline='') as file:
+        return sum(1 for row in csv.reader(file)) - 1
+
+def load_csv(connection, tablename, csv_file, columns, first_id,
+             with_link_columns=False, chunk_size=10000):
+    """
+    Stream the rows of a csv file into an existing table, in chunks of
+    chunk_size rows inserted with executemany and bound parameters, so
+    text columns need no quoting.
+
+    The rows are given consecutive ids starting at first_id, in the
+    order of the file, in place of the id column of the csv.  Since
+    each file continues where the previous one stopped, the ids of a
+    table are always exactly 1, ..., N, which lets the tables look up
+    the n-th manifold by its primary key.  If with_link_columns is
+    set, the link_columns are computed from the name and cusps of each
+    row.  The isosig column, if any, is computed from the triangulation,
+    see canonical_isosig, and the DT_key and DT_ints columns from the DT
+    code.  The isosigs and, on a machine with several cores, the DT
+    keys are computed by a pool of processes, a chunk at a time.  With
+    compact_storage, the triangulation, isosig and DT are then packed
+    into blobs.  Returns the number of rows and the largest id
+    inserted.
+    """
+    all_columns = table_columns(columns, with_link_columns)
+    with_isosigs = 'isosig' in all_columns
+    pool = None
+    if with_isosigs or ('DT' in columns and (os.cpu_count() or 1) > 1):
+        import multiprocessing
+        pool = multiprocessing.Pool()
+    insert_query = 'insert into %s (%s) values (%s)' % (
+        tablename, ', '.join(all_columns),
+        ', '.join('?' for column in all_columns))
+    if with_link_columns:
+        name_col, cusps_col = columns.index('name'), columns.index('cusps')
+    if 'triangulation' in columns:
+        triangulation_col = columns.index('triangulation')
+    if 'DT' in columns:
+        DT_col = columns.index('DT')
+    next_id = first_id
+    rows = csv_rows(os.path.join(csv_dir, csv_file), columns)
+    try:
+        for chunk in chunks(rows, chunk_size):
+            if with_isosigs:
+                triangulations = [row[triangulation_col] for row in chunk]
+                isosigs = pool.map(canonical_isosig, triangulations,
+                                   chunksize=256)
+            if 'DT' in columns:
+                DTs = [row[DT_col] for row in chunk]
+                if pool is None:
+                    DT_keys = [DT_key(DT) for DT in DTs]
+                else:
+                    DT_keys = pool.map(DT_key, DTs, chunksize=256)
+            for position, row in enumerate(chunk):
+                row[0] = next_id
+                next_id += 1
+                if with_isosigs:
+                    isosig = isosigs[position]
+                    row.append(pack_isosig(isosig) if compact_storage
+                               else isosig)
+                if 'DT' in columns:
+                    row += [DT_keys[position], pack_DT_ints(row[DT_col])]
+                if compact_storage:
+                    if 'triangulation' in columns:
+                        row[triangulation_col] = pack_isosig(
+                            row[triangulation_col])
+                    if 'DT' in columns:
+                        row[DT_col] = pack_DT(row[DT_col])
+                if with_link_columns:
+                    row += link_data(row[name_col], row[cusps_col])
+            connection.executemany(insert_query, chunk)
+    finally:
+        if pool is not None:
+            pool.terminate()
+    connection.commit()
+    return next_id - first_id, next_id - 1
+
+def report_rate(tablename, num_rows, start):
+    elapsed = max(time.time() - start, 1e-6)
+    print('inserted %d rows into %s in %.1f s (%d rows/sec)' %
+          (num_rows, tablename, elapsed, num_rows / elapsed))
+
+def make_table(connection, tablename, csv_files, name_index=True,
+               with_link_columns=False, chunk_size=10000):
     """
     Given a csv of manifolds data and a connection to a sqlite database,
     insert the data into a new table. If the csv file is in a subdirectory
     of the csv directory csv_dir, it is given by sub_dir.
+
+    The rows are streamed from the csv files and inserted in chunks of
+    chunk_size rows with executemany and bound parameters, so text
+    columns need no quoting.  The indices are created once all of the
+    data has been loaded.  Each csv file is recorded in the build
+    manifest.
+
+    If with_link_columns is set, the table gets the link_columns and
+    a composite index on them.  With canonical_isosigs, a table with a
+    triangulation column gets the isosig column and an index on it,
+    which is unique unless two rows have the same triangulation.  A table with a DT column
+    gets the DT_key column, with an index, and the DT_ints column.
     """
     # Get the column names from the first csv file
-    first_csv_file = open(os.path.join(csv_dir, csv_files[0]), 'r')
-    csv_reader = csv.reader(first_csv_file)
-    columns = next(csv_reader)
+    columns = csv_columns(csv_files[0])
     
     schema = "CREATE TABLE %s (id integer primary key" % tablename
-    for column in columns[1:]: #first column is always id
+    for column in table_columns(columns, with_link_columns)[1:]: #first column is always id
         schema += ",%s %s" % (column,schema_types[column])
     schema += ")"
     print('creating ' + tablename)
     connection.execute(schema)
+    connection.execute(manifest_schema)
+    connection.execute('delete from build_manifest where tablename=?',
+                       (tablename,))
     connection.commit()
-    
-    insert_query = "insert into %s ("%tablename
-    for column in columns:
-        insert_query += "%s, " %column
-    insert_query = insert_query[:-2] #one comma too many
-    insert_query += ') values ('
-    for column in columns:
-        if schema_types[column] == 'text':
-            insert_query += "'%s', "
-        else:
-            insert_query += "%s, "
-    insert_query = insert_query[:-2] #one comma too many
-    insert_query += ')'
 
-    for csv_file in csv_files:
-        csv_reader = csv.reader(open(os.path.join(csv_dir, csv_file)))
-        assert columns == next(csv_reader)
-        for row in csv_reader:
-            data_list = row
-            for i,data in enumerate(data_list): #chernsimons is None sometimes
-                if data == 'None':
-                    data_list[i] = 'Null'
-            connection.execute(insert_query%tuple(data_list))
+    start, next_id = time.time(), 1
+    for position, csv_file in enumerate(csv_files):
+        hash = file_hash(csv_file)
+        num_rows, last_id = load_csv(
+            connection, tablename, csv_file, columns, next_id,
+            with_link_columns, chunk_size)
+        record_in_manifest(connection, tablename, position, csv_file, hash,
+                           next_id, last_id)
+        next_id = last_id + 1
+    total_rows = next_id - 1
+    report_rate(tablename, total_rows, start)
 
     # We need to index columns that will be queried frequently for speed.
 
     indices = ['hash', 'volume']
     if name_index:
         indices += ['name']
+    if 'DT' in columns:
+        indices += ['DT_key']
     #print('Indices: {}'.format(indices))
     for column in indices:
         connection.execute(
             'create index %s_by_%s on %s (%s)'%
             (tablename, column, tablename, column))
+    if with_link_columns:
+        connection.execute(
+            'create index %s_by_structure on %s (%s)' %
+            (tablename, tablename, ', '.join(link_columns)))
+    if 'isosig' in table_columns(columns):
+        # Check first, since a failed create cannot be rolled back
+        # without a journal.
+        repeats = connection.execute(
+            'select count(isosig) - count(distinct isosig) from %s' %
+            tablename).fetchone()[0]
+        if repeats:
+            print('Warning: %s has %d repeated triangulations, so its '
+                  'isosig index is not unique' % (tablename, repeats))
+        connection.execute(
+            'create %s index %s_by_isosig on %s (isosig)' %
+            ('' if repeats else 'unique', tablename, tablename))
+    # The statistics let the query planner skip-scan the composite
+    # index when the leading column is not constrained.
+    connection.execute('analyze %s' % tablename)
+    connection.commit()
+    write_metadata(connection, tablename, with_link_columns)
+    write_arrays(connection, tablename)
+    write_bloom_filter(connection, tablename)
+
+def drop_table(connection, tablename):
+    connection.execute('drop table if exists %s' % tablename)
+    connection.execute(manifest_schema)
+    connection.execute('delete from build_manifest where tablename=?',
+                       (tablename,))
     connection.commit()
-            
-def is_stale(dbfile, sourceinfo):
-    if not os.path.exists(dbfile):
+
+def update_table(connection, tablename, csv_files, name_index=True,
+                 with_link_columns=False, chunk_size=10000):
+    """
+    Bring a table up to date with its csv files, using the hashes in
+    the build manifest.  When only some of the csv files have changed,
+    the rows coming from those files are deleted and reloaded, and new
+    files at the end of the list are appended; the existing indices are
+    maintained by sqlite as the rows change.  If a changed file has a
+    different number of rows, the files after it are reloaded as well
+    so that the ids stay consecutive.  The table is rebuilt from
+    scratch when a file was removed or reordered, when the columns
+    changed, or when it was written with a different schema_version
+    or isosig_mode or storage_mode.
+    Returns True if anything was done.
+    """
+    manifest = read_manifest(connection, tablename)
+    old_files = [row[0] for row in manifest]
+    columns = csv_columns(csv_files[0])
+    expected_columns = table_columns(columns, with_link_columns)
+    existing_columns = [row[1] for row in connection.execute(
+        "pragma table_info('%s')" % tablename)]
+    metadata = read_metadata(connection, tablename)
+    if (existing_columns != expected_columns
+        or metadata.get('schema_version') != schema_version
+        or metadata.get('isosigs') != isosig_mode()
+        or metadata.get('storage') != storage_mode()
+        or old_files != csv_files[:len(old_files)]
+        or any(csv_columns(csv_file) != columns for csv_file in csv_files)):
+        drop_table(connection, tablename)
+        make_table(connection, tablename, csv_files, name_index,
+                   with_link_columns, chunk_size)
         return True
-    dbmodtime = os.path.getmtime(dbfile)
-    for table in sourceinfo:
-        for csv_file in sourceinfo[table]['csv_files']:
-            csv_path = os.path.join(csv_dir, csv_file)
-            if os.path.getmtime(csv_path) > dbmodtime:
-                return True
-    return False
-    
+
+    # Find the files to reload and delete their old rows.  A first_id
+    # of None means that the file continues after the previous one.
+    changed, shifted = [], False
+    for position, csv_file in enumerate(csv_files):
+        hash = file_hash(csv_file)
+        if position < len(manifest):
+            old_hash, first_id, last_id = manifest[position][1:]
+            if old_hash == hash and not shifted:
+                continue
+            if not shifted:
+                shifted = count_csv_rows(csv_file) != last_id - first_id + 1
+                if shifted:
+                    connection.execute(
+                        'delete from %s where id >= ?' % tablename,
+                        (first_id,))
+                else:
+                    connection.execute(
+                        'delete from %s where id between ? and ?' % tablename,
+                        (first_id, last_id))
+                    changed.append((position, csv_file, hash, first_id))
+                    continue
+        changed.append((position, csv_file, hash, None))
+    if not changed:
+        # The .npy files are left alone, unless they were asked for
+        # and are missing.
+        if write_npy_arrays and not os.path.exists(
+                array_path(tablename, 'id')):
+            write_arrays(connection, tablename)
+        if not os.path.exists(bloom_path(tablename, 'hash')):
+            write_bloom_filter(connection, tablename)
+        return False
+
+    start, total_rows = time.time(), 0
+    last_ids = [row[3] for row in manifest]
+    for position, csv_file, hash, first_id in changed:
+        print('reloading %s into %s' % (csv_file, tablename))
+        if first_id is None:
+            first_id = last_ids[position - 1] + 1 if position > 0 else 1
+        num_rows, last_id = load_csv(
+            connection, tablename, csv_file, columns, first_id,
+            with_link_columns, chunk_size)
+        record_in_manifest(connection, tablename, position, csv_file,
+                           hash, first_id, last_id)
+        last_ids[position:position + 1] = [last_id]
+        total_rows += num_rows
+    connection.execute('analyze %s' % tablename)
+    connection.commit()
+    write_metadata(connection, tablename, with_link_columns)
+    write_arrays(connection, tablename)
+    write_bloom_filter(connection, tablename)
+    report_rate(tablename, total_rows, start)
+    return True
+
 if __name__ == '__main__':
     manifold_db = '15_knots.sqlite'
     manifold_data = {'HT_links': {'csv_files': ['knots_and_links_through_14.csv',
                                                 'alternating_knots_15.csv',
-                                                'nonalternating_knots_15.csv']}}
-    
-    if is_stale(manifold_db, manifold_data):
-        if os.path.exists(manifold_db):
-            os.remove(manifold_db)
-        with sqlite3.connect(manifold_db) as connection:
-            for tablename, args in manifold_data.items():
-                make_table(connection, tablename, **args)
-            connection.execute(" create view HT_links_view as select * from HT_links")
+                                                'nonalternating_knots_15.csv'],
+                             'with_link_columns': True}}
+
+    # Check that the modules which the build options need are there
+    # before touching the database.
+    isosig_mode()
+    if write_npy_arrays:
+        import numpy
 
+    # Only the tables, or the parts of tables, whose csv sources have
+    # changed are rebuilt.  That is done in a copy of the database,
+    # with the build_pragmas, which replaces the database only if the
+    # build finishes and changed something, so an interrupted build
+    # leaves the database as it was.
+    work_db = manifold_db + '.build'
+    if os.path.exists(manifold_db):
+        shutil.copyfile(manifold_db, work_db)
+    elif os.path.exists(work_db):
+        os.remove(work_db)
+    changed = not os.path.exists(manifold_db)
+    try:
+        connection = sqlite3.connect(work_db)
+        try:
+            configure_for_build(connection)
+            for tablename, args in manifold_data.items():
+                changed = update_table(connection, tablename, **args) or changed
+            connection.execute("create view if not exists HT_links_view "
+                               "as select * from HT_links")
+            connection.commit()
+        finally:
+            connection.close()
+        if changed:
+            os.replace(work_db, manifold_db)
+    finally:
+        if os.path.exists(work_db):
+            os.remove(work_db)
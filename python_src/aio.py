@@ -0,0 +1,99 @@
+"""
+Async counterparts of the table lookups, for use from asyncio
+applications.  Each lookup runs on a bounded pool of worker threads,
+each of which reads through its own read-only connection from the
+ConnectionPool of the database, so the event loop is never blocked by
+sqlite or by building Manifolds.  The methods of the tables which use
+this module are
+
+  await table.aget(name_or_index)
+  await table.aget_many(names_or_indices)
+  async for M in table[a:b]: ...
+
+The size of the thread pool is set by SNAPPY_15_KNOTS_ASYNC_WORKERS in
+the environment, 4 by default, or by calling set_executor.
+"""
+
+import os, asyncio, threading, collections
+from concurrent.futures import ThreadPoolExecutor
+
+max_workers = int(os.environ.get('SNAPPY_15_KNOTS_ASYNC_WORKERS', '4'))
+
+_executor = None
+_executor_lock = threading.Lock()
+
+def executor():
+    """
+    The thread pool used for the async lookups, made on first use.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers, thread_name_prefix='snappy_15_knots')
+        return _executor
+
+def set_executor(new_executor):
+    """
+    Use the given concurrent.futures.Executor for the async lookups.
+    It must run its jobs in threads, not processes.
+    """
+    global _executor
+    with _executor_lock:
+        _executor = new_executor
+
+def run(func, *args):
+    """
+    Run func(*args) in the executor, returning an awaitable.
+    """
+    loop = asyncio.get_running_loop()
+    return loop.run_in_executor(executor(), func, *args)
+
+async def aget(table, index):
+    return await run(table.__getitem__, index)
+
+async def aget_many(table, indices):
+    if hasattr(table, 'get_many'):
+        return await run(table.get_many, indices)
+    return await run(lambda: [table[index] for index in indices])
+
+class AsyncManifolds(object):
+    """
+    Async iterator over the manifolds of a table, in order.  The rows
+    are read and the Manifolds built batch_size at a time in the
+    executor, with at most one batch fetched ahead of the consumer, so
+    iterating over a large slice holds at most two batches in memory
+    however slowly the manifolds are used.
+    """
+    def __init__(self, table, batch_size=100):
+        self._table = table
+        self._batch_size = batch_size
+        self._last_id = None if table._min_id is None else table._min_id - 1
+        self._buffer = collections.deque()
+        self._pending = None
+
+    def __aiter__(self):
+        return self
+
+    def _fetch_batch(self):
+        """
+        Fetch the next batch_size manifolds, after the last id fetched;
+        called in the executor.
+        """
+        if self._last_id is None:
+            return []
+        batch, self._last_id = self._table._fetch_after(
+            self._last_id, self._batch_size)
+        return batch
+
+    async def __anext__(self):
+        if not self._buffer:
+            if self._pending is None:
+                self._pending = run(self._fetch_batch)
+            batch = await self._pending
+            if not batch:
+                self._pending = None
+                raise StopAsyncIteration
+            self._buffer.extend(batch)
+            self._pending = run(self._fetch_batch)
+        return self._buffer.popleft()
@@ -1,26 +1,507 @@
 from __future__ import print_function
-import sys, sqlite3, re, os, random
+import sys, sqlite3, re, os, random, numbers, collections, threading
+import bisect, time, logging, contextlib, json, struct, mmap
+from array import array
 import snappy_manifolds
 
 # This module uses sqlite3 databases with multiple tables.
 # The path to the database file is specified at the module level.
 from .sqlite_files import __path__ as manifolds_paths
+# The encodings of the columns written by the build are shared with it.
+from .sqlite_files.make_sqlite_db import (
+    undecorated_isosig, DT_key, pack_isosig, unpack_isosig, unpack_DT,
+    unpack_DT_ints, bloom_bits, bloom_header, bloom_magic, bloom_path,
+    array_path, column_array)
 manifolds_path = manifolds_paths[0]
 database_path = os.path.join(manifolds_path, '15_knots.sqlite')
 
 split_filling_info = re.compile(r'(.*?)((?:\([0-9 .+-]+,[0-9 .+-]+\))*$)')
 
-def get_tables(ManifoldTable):
+def is_int(index):
+    """
+    Accepts Python ints as well as, e.g., Sage Integers.
+    """
+    return isinstance(index, numbers.Integral) and not isinstance(index, bool)
+
+def is_int_or_none(index):
+    return index is None or is_int(index)
+
+def is_float_or_none(index):
+    return index is None or isinstance(index, numbers.Real) and not is_int(index)
+
+# Set SNAPPY_15_KNOTS_VOLUME_INDEX=1 in the environment to answer the
+# lengths of volume slices from a VolumeIndex.
+use_volume_index = os.environ.get('SNAPPY_15_KNOTS_VOLUME_INDEX', '0') != '0'
+
+class VolumeIndex(object):
+    """
+    The volumes of all rows of a table in increasing order, as a
+    compact array('d'), with the ids of the rows in a parallel
+    array('q').  Counting the manifolds in a range of volumes, or
+    finding those nearest to a volume, is then a binary search with no
+    SQL.  It takes about 16 bytes per row.
+    """
+    def __init__(self, cursor, table):
+        self.volumes, self.ids = array('d'), array('q')
+        query = ('select volume, id from %s where volume is not null '
+                 'order by volume, id' % table)
+        for volume, id in cursor.execute(query):
+            self.volumes.append(volume)
+            self.ids.append(id)
+
+    def bounds(self, start=None, stop=None):
+        """
+        The positions a <= b such that the rows a, ..., b - 1 are the
+        ones with start <= volume < stop; a bound of None is ignored.
+        """
+        a = 0 if start is None else bisect.bisect_left(self.volumes, start)
+        b = (len(self.volumes) if stop is None else
+             bisect.bisect_left(self.volumes, stop))
+        return a, max(a, b)
+
+    def nearest(self, volume, k=1):
+        """
+        The positions of the k rows whose volumes are nearest to the
+        given one, nearest first.
+        """
+        volumes = self.volumes
+        below = bisect.bisect_left(volumes, volume)
+        above, below = below, below - 1
+        positions = []
+        while len(positions) < k and (below >= 0 or above < len(volumes)):
+            if above == len(volumes) or (
+                    below >= 0 and volume - volumes[below] <= volumes[above] - volume):
+                positions.append(below)
+                below -= 1
+            else:
+                positions.append(above)
+                above += 1
+        return positions
+
+volume_indices = {}
+volume_indices_lock = threading.Lock()
+
+def volume_index(cursor, db_path, table, load=True):
+    """
+    The VolumeIndex of a table, which is built on first use and then
+    shared.  Returns None if it has not been built and load is False.
+    """
+    key = (db_path, table)
+    with volume_indices_lock:
+        if key not in volume_indices and load:
+            volume_indices[key] = VolumeIndex(cursor, table)
+        return volume_indices.get(key)
+
+# An HT name such as K15n1234 is a prefix and an index.
+split_HT_name = re.compile(r'([KL][0-9]+[an])([0-9]+)$')
+
+class NameOffsets(object):
+    """
+    The name_offsets table written with the database, which records
+    runs of rows with consecutive ids named prefix + first_index, ...,
+    prefix + last_index.  An HT name can then be resolved to the id of
+    its row by a binary search and some arithmetic, and its row
+    fetched by primary key rather than through the index on names.
+    Databases without a name_offsets table give no runs.
+    """
+    def __init__(self, cursor, table):
+        self.runs = {}
+        try:
+            rows = cursor.execute(
+                'select prefix, first_index, last_index, first_id '
+                'from name_offsets where tablename=? '
+                'order by prefix, first_index', (table,)).fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+        for prefix, first_index, last_index, first_id in rows:
+            starts, runs = self.runs.setdefault(prefix, ([], []))
+            starts.append(first_index)
+            runs.append((first_index, last_index, first_id))
+
+    def id(self, name):
+        """
+        The id of the row with the given name, or None if the name is
+        not in any run.  Callers should check the name of the row,
+        since e.g. K14n01 resolves to the id of K14n1.
+        """
+        match = split_HT_name.match(name)
+        if match is None or match.group(1) not in self.runs:
+            return None
+        index = int(match.group(2))
+        starts, runs = self.runs[match.group(1)]
+        position = bisect.bisect_right(starts, index) - 1
+        if position < 0:
+            return None
+        first_index, last_index, first_id = runs[position]
+        if index > last_index:
+            return None
+        return first_id + index - first_index
+
+name_offsets = {}
+name_offsets_lock = threading.Lock()
+
+def name_offsets_of(cursor, db_path, table):
+    """
+    The NameOffsets of a table, which are read on first use and then
+    shared.
+    """
+    key = (db_path, table)
+    with name_offsets_lock:
+        if key not in name_offsets:
+            name_offsets[key] = NameOffsets(cursor, table)
+        return name_offsets[key]
+
+# Set SNAPPY_15_KNOTS_BLOOM_FILTER=0 in the environment to look up every
+# hash in the database, ignoring the Bloom filters.
+use_bloom_filter = os.environ.get('SNAPPY_15_KNOTS_BLOOM_FILTER', '1') != '0'
+
+# Databases built with SNAPPY_15_KNOTS_COMPACT=1 hold blobs in some
+# columns, see make_sqlite_db.py; these are the functions which turn the
+# values of those columns back into text, or ints for DT_ints.
+unpackers = {'triangulation': unpack_isosig, 'isosig': unpack_isosig,
+             'DT': unpack_DT, 'DT_ints': unpack_DT_ints}
+
+def unpack_row(row):
+    """
+    A (name, triangulation, DT, ...) row with the triangulation and DT
+    as text.
+    """
+    if isinstance(row[1], bytes) or isinstance(row[2], bytes):
+        return (row[0], unpack_isosig(row[1]), unpack_DT(row[2])) + tuple(
+            row[3:])
+    return row
+
+class BloomFilter(object):
+    """
+    The Bloom filter of the values of a column written by
+    make_sqlite_db.py next to the database, as <table>.<column>.bloom,
+    and memory-mapped here.  A value which is not in the filter is
+    certainly not in the column, so the lookup can be skipped; a value
+    which is in it may still not be, with the false positive rate
+    recorded in the metadata table, about 1% as built.
+    """
+    header = struct.Struct(bloom_header)
+    magic = bloom_magic
+
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            self._bits = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.num_bits, self.num_hashes = self.header.unpack_from(
+            self._bits)
+        if magic != self.magic:
+            raise ValueError('%s is not a Bloom filter.' % path)
+
+    def __contains__(self, key):
+        bits, offset = self._bits, self.header.size
+        for bit in bloom_bits(key, self.num_bits, self.num_hashes):
+            if not bits[offset + (bit >> 3)] >> (bit & 7) & 1:
+                return False
+        return True
+
+bloom_filters = {}
+bloom_filters_lock = threading.Lock()
+
+def bloom_filter(db_path, table, column='hash'):
+    """
+    The BloomFilter of a column of a table, mapped on first use, or
+    None if there is none or use_bloom_filter is not set.
+    """
+    if not use_bloom_filter:
+        return None
+    key = (db_path, table, column)
+    with bloom_filters_lock:
+        if key not in bloom_filters:
+            path = os.path.join(os.path.dirname(db_path),
+                                bloom_path(table, column))
+            try:
+                bloom_filters[key] = BloomFilter(path)
+            except (EnvironmentError, ValueError, struct.error):
+                bloom_filters[key] = None
+        return bloom_filters[key]
+
+class LazyTable(object):
+    """
+    Stands in for a table which is only constructed, and so only opens
+    its database connection, when it is first used.  This keeps
+    "import snappy" from touching the database at all.
+
+    Since snappy names the tables it imports by
+    table.__class__.__name__, the __class__ attribute reports the class
+    of the table without constructing it.
+    """
+    def __init__(self, table_class, **kwargs):
+        self._lazy_class = table_class
+        self._lazy_kwargs = kwargs
+        self._lazy_table = None
+
+    @property
+    def __class__(self):
+        return self._lazy_class
+
+    def _target(self):
+        if self._lazy_table is None:
+            self._lazy_table = self._lazy_class(**self._lazy_kwargs)
+        return self._lazy_table
+
+    def __getattr__(self, attr):
+        if attr.startswith('_lazy_'):
+            raise AttributeError(attr)
+        return getattr(self._target(), attr)
+
+    def __repr__(self):
+        return repr(self._target())
+
+    def __call__(self, **kwargs):
+        return self._target()(**kwargs)
+
+    def __len__(self):
+        return len(self._target())
+
+    def __iter__(self):
+        return iter(self._target())
+
+    def __contains__(self, mfld):
+        return mfld in self._target()
+
+    def __getitem__(self, index):
+        return self._target()[index]
+
+    def __aiter__(self):
+        return self._target().__aiter__()
+
+timer = getattr(time, 'perf_counter', time.time)
+logger = logging.getLogger('snappy_15_knots')
+
+class QueryStats(object):
+    """
+    Counters filled in by an instrumented table: the number of
+    statements it executed, the wall time spent executing them and
+    fetching their rows, the number of rows fetched, and the time
+    spent building Manifolds from rows, of which finalize_time is in
+    _finalize.  The same figures for each distinct statement are in
+    by_statement, and the statements as sqlite ran them, with their
+    parameters bound, are in trace, as reported by its trace callback.
+
+    If slow_query_time is set, each statement which takes longer than
+    that many seconds is logged to the snappy_15_knots logger, together
+    with its EXPLAIN QUERY PLAN.
+    """
+    def __init__(self, slow_query_time=None, trace_size=1000):
+        self.slow_query_time = slow_query_time
+        self.trace = collections.deque(maxlen=trace_size)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.statements = 0
+            self.statement_time = 0.0
+            self.rows = 0
+            self.manifolds = 0
+            self.manifold_time = 0.0
+            self.finalize_time = 0.0
+            # statement -> [executions, time, rows]
+            self.by_statement = collections.OrderedDict()
+            self.trace.clear()
+
+    def __repr__(self):
+        return ('QueryStats(statements=%d, statement_time=%.6f, rows=%d, '
+                'manifolds=%d, manifold_time=%.6f, finalize_time=%.6f)' % (
+                    self.statements, self.statement_time, self.rows,
+                    self.manifolds, self.manifold_time, self.finalize_time))
+
+    def _record(self, sql, elapsed, rows=0, execution=False):
+        with self._lock:
+            entry = self.by_statement.setdefault(sql, [0, 0.0, 0])
+            if execution:
+                self.statements += 1
+                entry[0] += 1
+            self.statement_time += elapsed
+            entry[1] += elapsed
+            self.rows += rows
+            entry[2] += rows
+
+    def _record_manifold(self, elapsed):
+        with self._lock:
+            self.manifolds += 1
+            self.manifold_time += elapsed
+
+    def _record_finalize(self, elapsed):
+        with self._lock:
+            self.finalize_time += elapsed
+
+class TracedCursor(object):
+    """
+    Wraps a sqlite3 cursor, recording in a QueryStats the statements it
+    executes, the time taken by each and the rows fetched.
+    """
+    def __init__(self, cursor, stats):
+        self._cursor, self._stats = cursor, stats
+        self._sql, self._parameters = None, ()
+        self._time, self._logged = 0.0, False
+
+    def __getattr__(self, attr):
+        return getattr(self._cursor, attr)
+
+    def execute(self, sql, parameters=()):
+        self._finish()
+        connection = self._cursor.connection
+        connection.set_trace_callback(self._stats.trace.append)
+        start = timer()
+        try:
+            self._cursor.execute(sql, parameters)
+        finally:
+            connection.set_trace_callback(None)
+        elapsed = timer() - start
+        self._sql, self._parameters, self._time = sql, parameters, elapsed
+        self._logged = False
+        self._stats._record(sql, elapsed, execution=True)
+        self._check_time()
+        return self
+
+    def _fetched(self, start, rows):
+        elapsed = timer() - start
+        self._time += elapsed
+        self._stats._record(self._sql, elapsed, rows)
+        self._check_time()
+
+    def fetchone(self):
+        start = timer()
+        row = self._cursor.fetchone()
+        self._fetched(start, 0 if row is None else 1)
+        if row is None:
+            self._finish()
+        return row
+
+    def fetchmany(self, size=None):
+        start = timer()
+        rows = self._cursor.fetchmany(
+            self._cursor.arraysize if size is None else size)
+        self._fetched(start, len(rows))
+        if not rows:
+            self._finish()
+        return rows
+
+    def fetchall(self):
+        start = timer()
+        rows = self._cursor.fetchall()
+        self._fetched(start, len(rows))
+        self._finish()
+        return rows
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    next = __next__
+
+    def _finish(self):
+        """
+        Called when all rows of the current statement have been
+        fetched, or it is replaced by another one.
+        """
+        self._sql = None
+
+    def _check_time(self):
+        """
+        Called after executing the current statement and after each
+        fetch, since a statement need not be read to the end; logs the
+        statement, once, as soon as the time spent on it reaches
+        slow_query_time.
+        """
+        sql, slow_query_time = self._sql, self._stats.slow_query_time
+        if (sql is None or self._logged or slow_query_time is None
+            or self._time < slow_query_time):
+            return
+        self._logged = True
+        try:
+            plan = self._cursor.connection.execute(
+                'explain query plan ' + sql, self._parameters).fetchall()
+            plan = '\n'.join('    ' + str(row[-1]) for row in plan)
+        except sqlite3.Error as error:
+            plan = '    (no query plan: %s)' % error
+        logger.warning('Slow query (%.3f s): %s\n%s', self._time, sql, plan)
+
+class TracedConnection(object):
+    """
+    Wraps a sqlite3 connection so that its cursors are TracedCursors.
+    """
+    def __init__(self, connection, stats):
+        self._connection, self._stats = connection, stats
+
+    def __getattr__(self, attr):
+        return getattr(self._connection, attr)
+
+    def cursor(self):
+        return TracedCursor(self._connection.cursor(), self._stats)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+class InstrumentedTable(object):
+    """
+    Opt-in instrumentation for the tables: within
+
+        with table.instrumented(slow_query_time=0.1) as stats:
+            ...
+
+    the queries made by the table, and the Manifolds it builds, are
+    counted and timed in the QueryStats stats; see QueryStats.  Outside
+    it the connections are used directly, at no cost.  The
+    instrumentation is kept by _stats_owner, which is the table itself
+    unless a subclass says otherwise.
+    """
+    _stats = None
+
+    def _stats_owner(self):
+        return self
+
+    @contextlib.contextmanager
+    def instrumented(self, stats=None, slow_query_time=None):
+        """
+        Context manager recording in stats, or in a new QueryStats
+        with the given slow_query_time, which it returns.
+        """
+        if stats is None:
+            stats = QueryStats(slow_query_time)
+        owner = self._stats_owner()
+        previous, owner._stats = owner._stats, stats
+        try:
+            yield stats
+        finally:
+            owner._stats = previous
+
+    def _traced(self, connection):
+        if self._stats is None:
+            return connection
+        return TracedConnection(connection, self._stats)
+
+def get_tables(ManifoldTable, in_memory=None, **settings):
     """
     Functions such as this one are meant to be called in the
     __init__.py module in snappy proper.  To avoid circular imports,
     it takes as argument the class ManifoldTable from database.py in
     snappy. From there, it builds all of the Manifold tables from the
     sqlite databases manifolds.sqlite and more_manifolds.sqlite in
-    manifolds_src, and returns them all as a list.
+    manifolds_src, and returns them all as a list.  Each table is
+    wrapped in a LazyTable, so nothing is read from the database
+    until the table is first used.
+
+    If in_memory is set, or if it is None and the environment variable
+    SNAPPY_15_KNOTS_IN_MEMORY=1 is set, the tables read from a copy of
+    the database in memory, made on first use; see memory_footprint.
+    Other keyword arguments override the connection settings; see
+    connection_defaults.
     """
+    if in_memory is None:
+        in_memory = in_memory_default
 
-    class LinkExteriorsTable(ManifoldTable):
+    class LinkExteriorsTable(ManifoldTable, InstrumentedTable):
         """
         Link exteriors usually know a DT code describing the associated link.
         """
@@ -30,10 +511,602 @@ def get_tables(ManifoldTable):
         # data from snappy_manifolds.
         #_select = 'select name, triangulation, DT, id from %s '
         _select = 'select name, triangulation, DT from %s '
+        # The table behind the view, as named in the metadata and .npy files.
+        _data_table = None
+
+        def __init__(self, table='', db_path=None, **kwargs):
+            self._pool = connection_pool(db_path, in_memory, **settings)
+            ManifoldTable.__init__(self, table=table, db_path=db_path,
+                                   **kwargs)
+
+        # Each thread reads through its own connection from the pool,
+        # so that a table can be used from many threads at once.
+        # ManifoldTable.__init__ opens a connection of its own to the
+        # database file, without our settings, which is closed again.
+
+        @property
+        def _connection(self):
+            return self._traced(self._pool.connection())
+
+        @_connection.setter
+        def _connection(self, connection):
+            connection.close()
+
+        @property
+        def _cursor(self):
+            return self._connection.cursor()
+
+        @_cursor.setter
+        def _cursor(self, cursor):
+            pass
+
+        def _stats_owner(self):
+            # The tables made from this one by filtering or slicing are
+            # instances of the same class, and are instrumented with it.
+            return self.__class__
+
+        def _manifold_factory(self, row, M=None):
+            row = unpack_row(row)
+            stats = self._stats
+            if stats is None:
+                return ManifoldTable._manifold_factory(self, row, M)
+            start = timer()
+            M = ManifoldTable._manifold_factory(self, row, M)
+            stats._record_manifold(timer() - start)
+            return M
 
         def _finalize(self, M, row):
+            stats = self._stats
+            if stats is not None:
+                start = timer()
             M.set_name(row[0])
-            M._set_DTcode(row[2])
+            M._set_DTcode(unpack_DT(row[2]))
+            if stats is not None:
+                stats._record_finalize(timer() - start)
+
+        def _configure(self, **kwargs):
+            """
+            Besides the ManifoldTable filters, accept volume_range=(start,
+            stop), which is what volume slices of an unfiltered table
+            become so that their lengths can come from a VolumeIndex.
+            A bound of None is ignored, and with no bounds at all there
+            is no volume condition, so rows without a volume are kept.
+            """
+            ManifoldTable._configure(self, **kwargs)
+            self._volume_range = None
+            start, stop = kwargs.get('volume_range', (None, None))
+            if start is not None or stop is not None:
+                conditions = ['(%s)' % self._filter] if self._filter else []
+                if start is not None:
+                    conditions.append('volume >= %r' % float(start))
+                if stop is not None:
+                    conditions.append('volume < %r' % float(stop))
+                if not self._filter:
+                    self._volume_range = (start, stop)
+                self._filter = ' and '.join(conditions)
+
+        def _volume_index(self, load=None):
+            if load is None:
+                load = use_volume_index
+            return volume_index(self._cursor, self._pool.db_path,
+                                self._table, load)
+
+        def _get_length(self):
+            """
+            Find the length and the range of ids in one query.  The ids
+            are 1, ..., N in the database, so when the ids of the
+            filtered rows are contiguous the n-th manifold is the one
+            with id _min_id + n.  For a volume slice of the whole table,
+            use the VolumeIndex if there is one.
+            """
+            index = self._volume_range and self._volume_index()
+            if index:
+                a, b = index.bounds(*self._volume_range)
+                self._length = b - a
+                self._min_id = min(index.ids[a:b]) if b > a else None
+                self._max_id = max(index.ids[a:b]) if b > a else None
+                self._ids_contiguous = (self._length > 0 and
+                    self._length == self._max_id - self._min_id + 1)
+                return
+            where_clause = 'where ' + self._filter if self._filter else ''
+            query = 'select count(*), min(id), max(id) from %s %s' % (
+                self._table, where_clause)
+            cursor = self._cursor.execute(query)
+            self._length, self._min_id, self._max_id = cursor.fetchone()
+            self._ids_contiguous = (self._length > 0 and
+                self._length == self._max_id - self._min_id + 1)
+
+        def __getitem__(self, index):
+            """
+            When the ids are contiguous, integer indices and integer
+            slices become primary key lookups instead of the
+            LIMIT/OFFSET scans used by ManifoldTable, and HT names are
+            resolved to ids with the NameOffsets of the table.
+            """
+            if isinstance(index, str) and self._data_table:
+                return self._get_by_name(index)
+            if (isinstance(index, slice) and not index.step
+                and not self._filter and is_float_or_none(index.start)
+                and is_float_or_none(index.stop)):
+                return self.__class__(volume_range=(index.start, index.stop))
+            if not self._ids_contiguous:
+                return ManifoldTable.__getitem__(self, index)
+            if isinstance(index, slice):
+                start, stop = index.start, index.stop
+                if (index.step or not is_int_or_none(start)
+                    or not is_int_or_none(stop)):
+                    return ManifoldTable.__getitem__(self, index)
+                start, stop, _ = slice(start, stop).indices(self._length)
+                conditions = ['(%s)' % self._filter] if self._filter else []
+                conditions += ['id >= %d' % (self._min_id + start),
+                               'id < %d' % (self._min_id + max(start, stop))]
+                return self.__class__(filter=' and '.join(conditions))
+            if not is_int(index):
+                return ManifoldTable.__getitem__(self, index)
+            if index < 0:
+                index = self._length + index
+            if not 0 <= index < self._length:
+                raise IndexError('Manifold index is out of bounds')
+            query = self._select + 'where id = %d' % (self._min_id + index)
+            row = self._cursor.execute(query).fetchone()
+            return self._manifold_factory(row)
+
+        def _get_by_name(self, name):
+            """
+            Fetch the manifold with the given name by primary key,
+            falling back to the index on names when the name is not in
+            a run of the name_offsets table.
+            """
+            id = name_offsets_of(self._cursor, self._pool.db_path,
+                                 self._data_table).id(name)
+            if id is not None:
+                query = self._select + 'where id = %d' % id
+                if self._filter:
+                    query += ' and (%s)' % self._filter
+                row = self._cursor.execute(query).fetchone()
+                if row is not None and row[0] == name:
+                    return self._manifold_factory(row)
+            return ManifoldTable.__getitem__(self, name)
+
+        def _get_max_volume(self):
+            index = self._volume_range and self._volume_index()
+            if index:
+                a, b = index.bounds(*self._volume_range)
+                self._max_volume = index.volumes[b - 1] if b > a else None
+            else:
+                ManifoldTable._get_max_volume(self)
+
+        def _id_ranges(self, where=None):
+            """
+            The ids of the rows of this table satisfying the extra
+            condition, if any, as a list of (first_id, count) ranges of
+            consecutive ids.
+            """
+            if where is None and self._ids_contiguous:
+                return [(self._min_id, self._length)]
+            conditions = ['(%s)' % cond for cond in [self._filter, where]
+                          if cond]
+            query = 'select id from %s ' % self._table
+            if conditions:
+                query += 'where ' + ' and '.join(conditions)
+            return id_ranges(row[0] for row in
+                             self._cursor.execute(query + ' order by id'))
+
+        def _sample_ids(self, k, rng, ranges):
+            """
+            Draw k distinct ids uniformly from the given ranges.
+            """
+            starts, total = [], 0
+            for first_id, count in ranges:
+                starts.append(total)
+                total += count
+            ids = []
+            for position in rng.sample(range(total), k):
+                i = bisect.bisect_right(starts, position) - 1
+                ids.append(ranges[i][0] + position - starts[i])
+            return ids
+
+        def _fetch_ids(self, ids):
+            """
+            The manifolds with the given ids, in the order of the
+            table, fetched with one query.
+            """
+            if not ids:
+                return []
+            query = self._select + 'where id in (%s) order by id' % (
+                ', '.join('%d' % id for id in ids))
+            return [self._manifold_factory(row)
+                    for row in self._cursor.execute(query)]
+
+        def identify_many(self, manifolds, extends_to_link=False,
+                          processes=None):
+            """
+            Identify each of the manifolds as identify does, returning
+            the list of the results in the same order.  The hashes of
+            all of them are computed first and all of the candidates
+            fetched with one query on the hash index; the isometry
+            checks then run on that result set, in a pool of the given
+            number of processes if processes is set.  Unlike identify,
+            the candidates are all rows with the same hash, without
+            first matching the volume and homology.  Hashes which the
+            Bloom filter of the table rules out are not looked up.
+            """
+            results, positions = [], collections.OrderedDict()
+            for i, mfld in enumerate(manifolds):
+                if not self._may_contain(mfld, extends_to_link):
+                    results.append(False)
+                    continue
+                results.append(None)
+                positions.setdefault(self.mfld_hash(mfld), []).append(i)
+            bloom = self._bloom_filter()
+            hashes = [hash for hash in positions
+                      if bloom is None or hash in bloom]
+            candidates = self._rows_by_hash(hashes) if hashes else {}
+            tasks = []
+            for hash, indices in positions.items():
+                for i in indices:
+                    if hash not in candidates:
+                        results[i] = False
+                    else:
+                        tasks.append((i, manifolds[i], candidates[hash]))
+            if processes is None:
+                for i, mfld, rows in tasks:
+                    siblings = [self._manifold_factory(row) for row in rows]
+                    k = isometric_candidate(mfld, siblings, extends_to_link)
+                    results[i] = None if k is None else siblings[k]
+                return results
+            import multiprocessing
+            pool = multiprocessing.Pool(processes)
+            try:
+                matches = pool.map(identify_task, [
+                    (mfld, [unpack_isosig(row[1]) for row in rows],
+                     extends_to_link)
+                    for i, mfld, rows in tasks])
+            finally:
+                pool.terminate()
+            for (i, mfld, rows), k in zip(tasks, matches):
+                results[i] = None if k is None else self._manifold_factory(rows[k])
+            return results
+
+        def lookup_isosig(self, isosig):
+            """
+            Return the first manifold of this table whose triangulation
+            has the given isosig, ignoring any decoration or filling
+            info, or None if there is none.  This is one probe of the
+            index on the isosig column, which holds the canonical
+            isosigs given by M.triangulation_isosig(decorated=False).
+            Only databases built with SNAPPY_15_KNOTS_CANONICAL_ISOSIGS=1
+            have that column; the others give None.
+            """
+            rows = self._rows_by_isosig(isosig, 1)
+            return self._manifold_factory(rows[0]) if rows else None
+
+        def _rows_by_isosig(self, isosig, limit):
+            """
+            Up to limit rows with the given isosig, both as text and
+            packed as in a compact database, in order, with the id last.
+            """
+            if 'isosig' not in self.schema:
+                return []
+            query = 'select name, triangulation, DT, id from %s where ' % (
+                self._table)
+            if self._filter:
+                query += '(%s) and ' % self._filter
+            isosig = undecorated_isosig(isosig)
+            return self._cursor.execute(
+                query + 'isosig in (?, ?) order by id limit %d' % limit,
+                (isosig, pack_isosig(isosig))).fetchall()
+
+        def _first_id_with_hash(self, hash):
+            query = 'select min(id) from %s where ' % self._table
+            if self._filter:
+                query += '(%s) and ' % self._filter
+            return self._cursor.execute(
+                query + 'hash = ?', (hash,)).fetchone()[0]
+
+        def identify(self, mfld, extends_to_link=False):
+            """
+            As for ManifoldTable.identify, but first look for a
+            manifold with exactly the same triangulation, by the
+            canonical isosig of mfld, which is a single index lookup
+            and a query on the hash index, with no isometry checks.
+            This applies when all cusps of mfld are complete,
+            extends_to_link is not set and the database holds
+            canonical isosigs.  Since different manifolds in the table
+            may have the same triangulation, the match is only taken
+            when it is the only one and it is also the first manifold
+            with the hash of mfld, which ManifoldTable.identify would
+            check first and return; otherwise the answer is left to
+            ManifoldTable.identify.
+            """
+            if (not extends_to_link and self._isosigs() == 'canonical'
+                and False not in mfld.cusp_info('is_complete')
+                and self._may_contain(mfld, extends_to_link)):
+                rows = self._rows_by_isosig(
+                    mfld.triangulation_isosig(decorated=False), 2)
+                if (len(rows) == 1 and rows[0][3] ==
+                    self._first_id_with_hash(self.mfld_hash(mfld))):
+                    return self._manifold_factory(rows[0])
+            return ManifoldTable.identify(self, mfld, extends_to_link)
+
+        def _isosigs(self):
+            """
+            How the isosig column was made, as recorded in the metadata
+            by make_sqlite_db.py: 'canonical', or 'none' when there is
+            no isosig column.
+            """
+            if self._data_table is None:
+                return None
+            if not hasattr(self, '_isosig_mode'):
+                row = self._cursor.execute(
+                    "select value from metadata where tablename=? "
+                    "and key='isosigs'", (self._data_table,)).fetchone()
+                self._isosig_mode = None if row is None else row[0]
+            return self._isosig_mode
+
+        def _bloom_filter(self):
+            if self._data_table is None:
+                return None
+            return bloom_filter(self._pool.db_path, self._data_table)
+
+        def siblings(self, mfld):
+            """
+            As for ManifoldTable.siblings, but return no siblings,
+            without a query, when the Bloom filter of the table shows
+            that no manifold has the hash of mfld.
+            """
+            bloom = self._bloom_filter()
+            if bloom is not None and self.mfld_hash(mfld) not in bloom:
+                return []
+            return ManifoldTable.siblings(self, mfld)
+
+        def _may_contain(self, mfld, extends_to_link):
+            """
+            The checks made by identify before looking at the hash.
+            """
+            if hasattr(mfld, 'volume'):
+                if mfld.solution_type() in ['no solution found', 'not attempted']:
+                    return False
+                if mfld.volume() > self._max_volume + 0.1:
+                    return False
+            if extends_to_link and not (True in mfld.cusp_info('complete?')):
+                return False
+            return True
+
+        def _rows_by_hash(self, hashes):
+            """
+            Fetch the rows with any of the given hashes, with one query
+            if sqlite has the json_each function, and group them by
+            hash.
+            """
+            select = 'select name, triangulation, DT, hash from %s where ' % (
+                self._table)
+            if self._filter:
+                select += '(%s) and ' % self._filter
+            cursor = self._cursor
+            try:
+                rows = cursor.execute(
+                    select + 'hash in (select value from json_each(?)) '
+                    'order by id', (json.dumps(hashes),)).fetchall()
+            except sqlite3.OperationalError:
+                rows = []
+                for start in range(0, len(hashes), 500):
+                    chunk = hashes[start:start + 500]
+                    rows += cursor.execute(
+                        select + 'hash in (%s) order by id' % (
+                            ', '.join('?' for hash in chunk)), chunk).fetchall()
+            candidates = {}
+            for row in rows:
+                candidates.setdefault(row[3], []).append(row)
+            return candidates
+
+        def _fetch_after(self, last_id, limit):
+            """
+            The first limit manifolds of this table with id > last_id,
+            in order, and the id of the last of them, or last_id if
+            there are none.  This is one range scan of the primary key,
+            however sparse the filter of the table.
+            """
+            query = 'select name, triangulation, DT, id from %s where ' % (
+                self._table)
+            if self._filter:
+                query += '(%s) and ' % self._filter
+            rows = self._cursor.execute(
+                query + 'id > ? order by id limit ?',
+                (last_id, limit)).fetchall()
+            return ([self._manifold_factory(row) for row in rows],
+                    rows[-1][3] if rows else last_id)
+
+        # Async counterparts, which run in the thread pool of the aio
+        # module; it is only imported when they are used.
+
+        def aget(self, index):
+            """
+            Awaitable version of self[index].
+            """
+            from . import aio
+            return aio.aget(self, index)
+
+        def aget_many(self, indices):
+            """
+            Awaitable list of self[index] for each of the indices,
+            looked up together in one job.
+            """
+            from . import aio
+            return aio.aget_many(self, indices)
+
+        def aiter(self, batch_size=100):
+            """
+            Async iterator over the manifolds of this table, read in
+            batches; "async for M in table" uses batches of 100.
+            """
+            from . import aio
+            return aio.AsyncManifolds(self, batch_size)
+
+        def __aiter__(self):
+            return self.aiter()
+
+        def sample(self, k, seed=None, **filters):
+            """
+            Return k distinct manifolds drawn uniformly at random from
+            this table or, if filter arguments are given, from
+            self(**filters), in the order of the table.  Unlike calling
+            random() k times, the ids are drawn from the ranges of ids
+            of the table, with no queries when these are known, and the
+            manifolds are fetched with one query.  A seed makes the
+            sample reproducible.
+            """
+            table = self(**filters) if filters else self
+            rng = random.Random(seed)
+            return table._fetch_ids(
+                table._sample_ids(k, rng, table._id_ranges()))
+
+        def nearest_volume(self, volume, k=1):
+            """
+            Return the list of the k manifolds in this table whose
+            volumes are nearest to the given one, nearest first.  For
+            the unfiltered table this uses the VolumeIndex, which is
+            built the first time it is needed.
+            """
+            if not self._filter:
+                index = self._volume_index(load=True)
+                ids = [index.ids[p] for p in index.nearest(volume, k)]
+            else:
+                query = ('select id, volume from %s where (%s) and volume %s ? '
+                         'order by volume %s limit %d')
+                rows = []
+                for op, order in [('>=', 'asc'), ('<', 'desc')]:
+                    rows += self._cursor.execute(
+                        query % (self._table, self._filter, op, order, k),
+                        (volume,)).fetchall()
+                rows.sort(key=lambda row: abs(row[1] - volume))
+                ids = [row[0] for row in rows[:k]]
+            return [self._manifold_factory(self._cursor.execute(
+                self._select + 'where id = %d' % id).fetchone())
+                    for id in ids]
+
+        def iter_raw(self, columns=('name', 'triangulation'),
+                     batch_size=1000, named=False):
+            """
+            Generator yielding the given columns of the rows of this
+            table, with its filters, as tuples or, if named is set, as
+            namedtuples.  No Manifolds are built, so this is the fast
+            way to export, e.g., all of the isosigs.
+
+            >>> next(HTLinkExteriors[:1].iter_raw(['name', 'DT']))
+            ('K3a1', 'cacbca.001')
+            """
+            for column in columns:
+                if column not in self.schema:
+                    raise ValueError('There is no column %s.' % column)
+            where_clause = 'where ' + self._filter if self._filter else ''
+            query = 'select %s from %s %s order by id' % (
+                ', '.join(columns), self._table, where_clause)
+            return raw_rows(self._connection.cursor(), query, columns,
+                            batch_size, named)
+
+        def to_arrays(self, columns=None):
+            """
+            Return a dictionary of NumPy arrays, one for 'id', one for
+            'name' and one for each of the given numeric columns
+            (cusps, betti, volume, chernsimons, tets, ... by default),
+            whose i-th entries all describe the i-th manifold of this
+            table, with its filters.  The arrays for the whole table
+            are memory-mapped from the .npy files written when the
+            database was built with SNAPPY_15_KNOTS_ARRAYS=1, and those
+            of a filtered table are selected from them by id.  Without
+            the .npy files, the arrays are read from the database.
+            Either way the names are ASCII bytes and each integer
+            column has the narrowest integer dtype holding it; null
+            values are nan in real columns and -1 in integer columns.
+            """
+            import numpy
+            if columns is None:
+                columns = [column for column, type in self.schema.items()
+                           if type in ('int', 'real')]
+            columns = ['id', 'name'] + [column for column in columns
+                                        if column not in ('id', 'name')]
+            for column in columns:
+                if column not in self.schema:
+                    raise ValueError('There is no column %s.' % column)
+            where_clause = 'where ' + self._filter if self._filter else ''
+            directory = os.path.dirname(self._pool.db_path)
+            paths = [os.path.join(directory, array_path(
+                self._data_table, column)) for column in columns]
+            if self._data_table and all(os.path.exists(p) for p in paths):
+                arrays = dict((column, numpy.load(path, mmap_mode='r'))
+                              for column, path in zip(columns, paths))
+                if self._filter:
+                    query = 'select id from %s %s order by id' % (
+                        self._table, where_clause)
+                    ids = numpy.fromiter(
+                        (row[0] for row in self._cursor.execute(query)),
+                        dtype=numpy.int64)
+                    positions = numpy.searchsorted(arrays['id'], ids)
+                    arrays = dict((column, array[positions])
+                                  for column, array in arrays.items())
+                return arrays
+            query = 'select %s from %s %s order by id' % (
+                ', '.join(columns), self._table, where_clause)
+            rows = self._cursor.execute(query).fetchall()
+            return dict((column, column_array(
+                column, self.schema[column], [row[i] for row in rows]))
+                        for i, column in enumerate(columns))
+
+        def shards(self, n):
+            """
+            Split the manifolds of this table, with its filters, into at
+            most n shards of nearly equal size.  A Shard is a picklable
+            description of a range of ids, from which open_shard
+            rebuilds the table of its manifolds, with its own database
+            connection with the same settings, in another process.
+            """
+            n = max(1, min(n, self._length))
+            if self._length == 0:
+                return []
+            bounds = [k * self._length // n for k in range(n + 1)]
+            if self._ids_contiguous:
+                ids = [self._min_id + b for b in bounds[:-1]]
+            else:
+                # One pass over the id index finds the first id of each shard.
+                where_clause = 'where ' + self._filter if self._filter else ''
+                query = 'select id from %s %s order by id' % (
+                    self._table, where_clause)
+                wanted, ids = set(bounds[:-1]), []
+                for position, row in enumerate(self._cursor.execute(query)):
+                    if position in wanted:
+                        ids.append(row[0])
+            ids.append(self._max_id + 1)
+            conditions = ['(%s)' % self._filter] if self._filter else []
+            settings = tuple(sorted(self._pool.settings.items()))
+            return [Shard(self.__class__.__name__,
+                          ' and '.join(conditions + ['id >= %d' % ids[k],
+                                                     'id < %d' % ids[k + 1]]),
+                          bounds[k + 1] - bounds[k], self._pool.in_memory,
+                          settings)
+                    for k in range(n)]
+
+        def parallel_map(self, func, processes=None, shard_size=1000):
+            """
+            Generator yielding func(M) for each manifold M of this
+            table, in order, with the work spread over a pool of
+            processes.  The table is split into shards of about
+            shard_size manifolds, each of which is read by a worker
+            through its own connection; the results are yielded as
+            soon as the shards before them are done.  The function
+            must be picklable, e.g. defined at the top level of a
+            module.
+            """
+            import multiprocessing
+            num_shards = max(1, -(-self._length // shard_size))
+            tasks = [(func, shard) for shard in self.shards(num_shards)]
+            pool = multiprocessing.Pool(processes)
+            try:
+                for results in pool.imap(map_shard, tasks):
+                    for result in results:
+                        yield result
+            finally:
+                pool.terminate()
 
 
     class HTLinkExteriors(LinkExteriorsTable):
@@ -102,6 +1175,7 @@ def get_tables(ManifoldTable):
         """
 
         _regex = re.compile(r'[KL][0-9]+[an]([0-9]+)$')
+        _data_table = 'HT_links'
         
         def __init__(self, **kwargs):
             return LinkExteriorsTable.__init__(self,
@@ -114,76 +1188,657 @@ def get_tables(ManifoldTable):
             Process the ManifoldTable filter arguments and then add
             the ones which are specific to links.
             """
-            ManifoldTable._configure(self, **kwargs)
+            LinkExteriorsTable._configure(self, **kwargs)
+            # Set when the length and volume bounds can be read from
+            # the categories table built with the database.
+            self._category_filter = None if self._filter else ''
             conditions = []
 
+            # The crossings, alternating and components columns are
+            # derived from the name when the database is built, and
+            # share a composite index.
+            if 'crossings' in kwargs:
+                N = int(kwargs['crossings'])
+                conditions.append('crossings=%d' % N)
             alt = kwargs.get('alternating', None)
             if alt == True:
-                conditions.append("name like '%a%'")
+                conditions.append('alternating=1')
             elif alt == False:
-                conditions.append("name like '%n%'")
+                conditions.append('alternating=0')
             flavor = kwargs.get('knots_vs_links', None)
             if flavor == 'knots':
-                conditions.append('cusps=1')
+                conditions.append('components=1')
             elif flavor == 'links':
-                conditions.append('cusps>1')
-            if 'crossings' in kwargs:
-                N = int(kwargs['crossings'])
-                conditions.append(
-                    "(name like '_%da%%' or name like '_%dn%%')"%(N,N))
+                conditions.append('components>1')
             if self._filter:
                 if len(conditions) > 0:
                     self._filter += (' and ' + ' and '.join(conditions))
             else:
                 self._filter = ' and '.join(conditions)
+                self._category_filter = self._filter
+
+        def _category_query(self, columns):
+            query = 'select %s from categories where tablename=?' % columns
+            if self._category_filter:
+                query += ' and ' + self._category_filter
+            return self._cursor.execute(query, (self._data_table,)).fetchone()
+
+        def _get_length(self):
+            if self._category_filter is None:
+                return LinkExteriorsTable._get_length(self)
+            length, self._min_id, self._max_id = self._category_query(
+                'sum(rows), min(min_id), max(max_id)')
+            self._length = length or 0
+            self._ids_contiguous = (self._length > 0 and
+                self._length == self._max_id - self._min_id + 1)
+
+        def _get_max_volume(self):
+            if self._category_filter is None:
+                return LinkExteriorsTable._get_max_volume(self)
+            self._max_volume = self._category_query('max(max_volume)')[0]
+
+        def _id_ranges(self, where=None):
+            """
+            Read the ranges of ids from the categories table when each
+            category is a range of consecutive ids, which it is when
+            the rows are ordered by crossings and kind.
+            """
+            if self._category_filter is None:
+                return LinkExteriorsTable._id_ranges(self, where)
+            conditions = [cond for cond in [self._category_filter, where]
+                          if cond]
+            query = 'select min_id, max_id, rows from categories where tablename=?'
+            for condition in conditions:
+                query += ' and ' + condition
+            ranges = []
+            for min_id, max_id, rows in self._cursor.execute(
+                    query + ' order by min_id', (self._data_table,)):
+                if rows != max_id - min_id + 1:
+                    return LinkExteriorsTable._id_ranges(self, where)
+                ranges.append((min_id, rows))
+            return ranges
+
+        def _crossing_numbers(self):
+            if self._category_filter is None:
+                query = 'select distinct crossings from %s' % self._table
+                if self._filter:
+                    query += ' where ' + self._filter
+                cursor = self._cursor.execute(query)
+            else:
+                query = ('select distinct crossings from categories '
+                         'where tablename=?')
+                if self._category_filter:
+                    query += ' and ' + self._category_filter
+                cursor = self._cursor.execute(query, (self._data_table,))
+            return sorted(row[0] for row in cursor if row[0] is not None)
+
+        def sample(self, k, seed=None, per_crossings=False, **filters):
+            """
+            As for LinkExteriorsTable.sample, but if per_crossings is
+            set, draw k manifolds for each crossing number instead, or
+            all of them for crossing numbers with at most k, so that the
+            sample is stratified by crossing number.
+
+            >>> len(HTLinkExteriors.sample(10, seed=1, alternating=False))
+            10
+            """
+            if not per_crossings:
+                return LinkExteriorsTable.sample(self, k, seed, **filters)
+            table = self(**filters) if filters else self
+            rng = random.Random(seed)
+            ids = []
+            for N in table._crossing_numbers():
+                ranges = table._id_ranges('crossings=%d' % N)
+                size = sum(count for first_id, count in ranges)
+                ids += table._sample_ids(min(k, size), rng, ranges)
+            return table._fetch_ids(ids)
+
+    return [LazyTable(HTLinkExteriors)]
+
+
+def id_ranges(ids):
+    """
+    Compress increasing ids into a list of (first_id, count) ranges of
+    consecutive ids.
+    """
+    ranges = []
+    for id in ids:
+        if ranges and id == ranges[-1][0] + ranges[-1][1]:
+            ranges[-1][1] += 1
+        else:
+            ranges.append([id, 1])
+    return [tuple(r) for r in ranges]
+
+def isometric_candidate(mfld, candidates, extends_to_link=False):
+    """
+    The position of the first of the candidates which is isometric to
+    mfld, or None, checked as ManifoldTable.identify does: against
+    mfld and four randomizations of it and, failing that, by comparing
+    triangulations.
+    """
+    from snappy import Triangulation
+    mfld = mfld.copy()
+    mflds = [mfld]
+    for i in range(4):
+        mfld = mfld.copy()
+        mfld.randomize()
+        mflds.append(mfld)
+    for mfld in mflds:
+        for k, N in enumerate(candidates):
+            try:
+                if not extends_to_link:
+                    if mfld.is_isometric_to(N):
+                        return k
+                else:
+                    isoms = mfld.is_isometric_to(N, True)
+                    if True in [i.extends_to_link() for i in isoms]:
+                        return k
+            except RuntimeError:
+                pass
+    mfld = Triangulation(mflds[0])
+    if (False not in mfld.cusp_info('is_complete')) and not extends_to_link:
+        for n in range(100):
+            for k, N in enumerate(candidates):
+                if mfld == N:
+                    return k
+            mfld.randomize()
+    return None
+
+fillings_pattern = re.compile(r'\(([0-9 .+-]+),([0-9 .+-]+)\)')
+
+def identify_task(task):
+    """
+    Run isometric_candidate in a worker process, for
+    identify_many; the candidates are given by their triangulations.
+    """
+    from snappy import Manifold
+    mfld, triangulations, extends_to_link = task
+    candidates = []
+    for triangulation in triangulations:
+        isosig, fillings = split_filling_info.match(triangulation).groups()
+        N = Manifold(isosig)
+        fillings = [(float(a), float(b))
+                    for a, b in fillings_pattern.findall(fillings)]
+        if fillings:
+            N.dehn_fill(fillings)
+        candidates.append(N)
+    return isometric_candidate(mfld, candidates, extends_to_link)
 
-    return [HTLinkExteriors()]
+def raw_rows(cursor, query, columns, batch_size, named):
+    """
+    Generator yielding the results of a query fetched in batches of
+    batch_size rows, as namedtuples with the given fields if named is
+    set.  Packed triangulation, isosig and DT columns are returned as
+    text, and the DT_ints column as a list of tuples of ints.
+    """
+    record = collections.namedtuple('Row', columns) if named else None
+    unpack = [(i, unpackers[column]) for i, column in enumerate(columns)
+              if column in unpackers]
+    cursor.execute(query)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            if unpack:
+                row = list(row)
+                for i, unpacker in unpack:
+                    row[i] = unpacker(row[i])
+                row = tuple(row)
+            yield record._make(row) if named else row
+
+# A range of rows of a table, as produced by LinkExteriorsTable.shards.
+# The filter includes those of the table that was split, and in_memory
+# and settings, as a sorted tuple of items, are those of its connections.
+Shard = collections.namedtuple('Shard', ['table_class', 'filter', 'length',
+                                         'in_memory', 'settings'])
+
+shard_tables = {}
+
+def open_shard(shard):
+    """
+    The table of the manifolds in a Shard.  This is meant to be called
+    in worker processes, which import snappy and build their own
+    tables, and so open their own connections.
+    """
+    key = (shard.table_class, shard.in_memory, shard.settings)
+    if key not in shard_tables:
+        from snappy.database import ManifoldTable
+        for table in get_tables(ManifoldTable, shard.in_memory,
+                                **dict(shard.settings)):
+            shard_tables[(table.__class__.__name__,) + key[1:]] = (
+                table.__class__)
+    return shard_tables[key](filter=shard.filter)
+
+def map_shard(task):
+    """
+    Apply a function to each manifold of a shard; used by
+    parallel_map.
+    """
+    func, shard = task
+    return [func(M) for M in open_shard(shard)]
 
+# The read-side settings of the connections to a database file.  Each
+# can be overridden by setting SNAPPY_15_KNOTS_<NAME> in the environment,
+# e.g. SNAPPY_15_KNOTS_MMAP_SIZE=0, or by a keyword argument to
+# connect_to_db, get_tables or get_DT_tables.
+#
+# mmap_size: bytes of the file which sqlite reads through a memory
+#   map rather than with read() calls; None means the whole file.
+# cache_size: the private page cache of each connection, in pages, or
+#   in KiB if negative.  With the file mapped, the pages are already
+#   shared through the OS page cache, so this can be small.
+# temp_store: where sorts and temporary b-trees are kept.
+# query_only: refuse writes, even if the file is writable.
+# immutable: promise sqlite that the file never changes, so it takes
+#   no locks and never checks for changes; None means only for the
+#   packaged database, which is never rewritten while installed.
+connection_defaults = {
+    'mmap_size': None,
+    'cache_size': -8192,
+    'temp_store': 'memory',
+    'query_only': 1,
+    'immutable': None,
+}
 
-def connect_to_db(db_path):
+pragma_value = re.compile(r'-?[0-9]+$|[A-Za-z]+$')
+
+def connection_settings(db_path, **kwargs):
+    """
+    The settings for a connection to the given database: the
+    connection_defaults, overridden by the environment and then by
+    the keyword arguments.
+    """
+    settings = dict(connection_defaults)
+    for name in settings:
+        value = os.environ.get('SNAPPY_15_KNOTS_' + name.upper())
+        if value is not None:
+            settings[name] = value
+    for name, value in kwargs.items():
+        if name not in settings:
+            raise TypeError('Unknown connection setting %s.' % name)
+        settings[name] = value
+    if settings['mmap_size'] is None:
+        try:
+            settings['mmap_size'] = os.path.getsize(db_path)
+        except OSError:
+            settings['mmap_size'] = 0
+    if settings['immutable'] is None:
+        settings['immutable'] = db_path == database_path
+    settings['immutable'] = str(settings['immutable']).lower() not in (
+        '0', 'false', 'no', 'off')
+    for name in ('mmap_size', 'cache_size', 'temp_store', 'query_only'):
+        if not pragma_value.match(str(settings[name])):
+            raise ValueError('Bad value %r for the connection setting %s.'
+                             % (settings[name], name))
+    return settings
+
+def configure_connection(connection, settings):
     """
-    Open the given sqlite database, ideally in read-only mode.
+    Apply the pragmas of the given settings to a sqlite3 connection.
     """
+    for name in ('mmap_size', 'cache_size', 'temp_store', 'query_only'):
+        connection.execute('pragma %s = %s' % (name, settings[name]))
+    return connection
+
+def connect_to_db(db_path, **kwargs):
+    """
+    Open the given sqlite database, ideally in read-only mode, with
+    the read-side settings described at connection_defaults; keyword
+    arguments override them.
+    """
+    settings = connection_settings(db_path, **kwargs)
     if sys.version_info >= (3,4):
         uri = 'file:' + db_path + '?mode=ro'
-        return sqlite3.connect(uri, uri=True)
+        if settings['immutable']:
+            uri += '&immutable=1'
+        return configure_connection(sqlite3.connect(uri, uri=True), settings)
     elif sys.platform.startswith('win'):
         try:
             import apsw
             return apsw.Connection(db_path, flags=apsw.SQLITE_OPEN_READONLY)
         except ImportError:
-            return sqlite3.connect(db_path)
+            return configure_connection(sqlite3.connect(db_path), settings)
     else:
-        return sqlite3.connect(db_path)
+        return configure_connection(sqlite3.connect(db_path), settings)
+
+# Set SNAPPY_15_KNOTS_IN_MEMORY=1 in the environment to make the
+# tables read from a copy of the database in memory by default.
+in_memory_default = os.environ.get('SNAPPY_15_KNOTS_IN_MEMORY', '0') != '0'
+
+class ConnectionPool(object):
+    """
+    Read-only connections to one database, one for each thread which
+    uses it.  A sqlite3 connection cannot be shared between threads,
+    but any number of read-only connections can read the database in
+    parallel.
+
+    If in_memory is set, the first use copies the whole database into
+    a shared-cache memory database with the sqlite backup API, and the
+    connections of all threads read that copy instead of the file.
+
+    A process forked from one which used the pool, such as a worker of
+    a multiprocessing pool, starts over with connections of its own.
+    """
+    def __init__(self, db_path, in_memory=False, **settings):
+        self.db_path = db_path
+        self.in_memory = in_memory
+        self.settings = settings
+        self._local = self._memory = None
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the connections, and the copy in memory, of the process
+        which created the pool; called in a forked child.  Those
+        connections must not be used, or closed, by the child, so they
+        are kept but left alone.
+        """
+        self._inherited = (self._local, self._memory)
+        self._pid = os.getpid()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._memory = None
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self.reset()
+
+    def _load_into_memory(self):
+        with self._lock:
+            if self._memory is None:
+                uri = 'file:snappy_15_knots_%x_%d?mode=memory&cache=shared' % (
+                    id(self), self._pid)
+                # This connection keeps the memory database alive.
+                memory = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                source = connect_to_db(self.db_path, **self.settings)
+                source.backup(memory)
+                source.close()
+                self._memory_uri, self._memory = uri, memory
+
+    def connection(self):
+        """
+        The connection of the current thread, which is opened on
+        first use.
+        """
+        self._check_pid()
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            if self.in_memory:
+                self._load_into_memory()
+                connection = sqlite3.connect(self._memory_uri, uri=True)
+                # The pages of a memory database live in its cache, so
+                # only the settings which do not size it apply.
+                settings = connection_settings(self.db_path, **self.settings)
+                for name in ('temp_store', 'query_only'):
+                    connection.execute('pragma %s = %s' % (name, settings[name]))
+            else:
+                connection = connect_to_db(self.db_path, **self.settings)
+            self._local.connection = connection
+        return connection
+
+    def memory_footprint(self):
+        """
+        The size in bytes of the copy of the database in memory, or 0
+        if it has not been made.
+        """
+        self._check_pid()
+        if self._memory is None:
+            return 0
+        with self._lock:
+            page_count = self._memory.execute('pragma page_count').fetchone()[0]
+            page_size = self._memory.execute('pragma page_size').fetchone()[0]
+        return page_count * page_size
+
+connection_pools = {}
+connection_pools_lock = threading.Lock()
+
+def connection_pool(db_path, in_memory=False, **settings):
+    """
+    The ConnectionPool for the given database and connection settings,
+    which is shared by all of the tables reading from it, so there is
+    at most one copy of each database in memory.
+    """
+    key = (db_path, bool(in_memory), tuple(sorted(settings.items())))
+    with connection_pools_lock:
+        if key not in connection_pools:
+            connection_pools[key] = ConnectionPool(db_path, in_memory,
+                                                   **settings)
+        return connection_pools[key]
 
-def get_DT_tables():
+def memory_footprint():
+    """
+    The total size in bytes of the databases copied into memory.
+    """
+    with connection_pools_lock:
+        pools = list(connection_pools.values())
+    return sum(pool.memory_footprint() for pool in pools)
+
+def reset_after_fork():
+    """
+    Give a forked child new locks, since another thread of the parent
+    may have held one when it forked, and reset the connection pools.
+    """
+    global connection_pools_lock, volume_indices_lock, name_offsets_lock
+    global bloom_filters_lock
+    connection_pools_lock = threading.Lock()
+    volume_indices_lock = threading.Lock()
+    name_offsets_lock = threading.Lock()
+    bloom_filters_lock = threading.Lock()
+    for pool in connection_pools.values():
+        pool.reset()
+
+# The pools also check the pid themselves, for Pythons without
+# os.register_at_fork.
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_after_fork)
+
+class LinkNotFoundError(KeyError, IndexError):
+    """
+    Raised when a name is not in a DTCodeTable.  It is also an
+    IndexError, which is what such lookups used to raise and what
+    spherogram expects.
+    """
+
+def get_DT_tables(in_memory=None, **settings):
     """
     Returns two barebones databases for looking up DT codes by name. 
+    The in_memory argument and connection settings are as for
+    get_tables; the tables from both functions share one copy of the
+    database in memory.
     """
-    class DTCodeTable(object):
+    if in_memory is None:
+        in_memory = in_memory_default
+    class DTCodeTable(InstrumentedTable):
         """
         A barebones database for looking up a DT code by knot/link name.
+        Each thread uses its own connection from the ConnectionPool of
+        the database, opened on first use, so lookups can be made from
+        many threads at once.
+
+        Single lookups use fixed statements with bound parameters,
+        which sqlite3 prepares once and then reuses; HT names are
+        resolved to ids with the NameOffsets of the data_table, so the
+        row is fetched by primary key.  The most
+        recent cache_size results are kept in an LRU cache; use
+        cache_size=0 to turn the cache off.  Use get_many to look up
+        many names at once.
+
+        Conversely, name_for_DT and names_for_DTs find links by their
+        DT codes, using the index on the DT_key column.
         """
-        def __init__(self, name='', table='', db_path=database_path, **filter_args):
+        def __init__(self, name='', table='', db_path=database_path,
+                     data_table=None, cache_size=1024, **filter_args):
             self._table = table
-            self._select = 'select DT from ' + table + ' '
+            self._data_table = data_table
+            self._select = 'select %s from ' + table + ' where name=?'
+            self._select_by_id = 'select %s, name from ' + table + ' where id=?'
+            self._select_by_DT_key = ('select name from ' + table +
+                                      ' where DT_key=? order by id limit 1')
             self.name = name
-            self._connection = connect_to_db(db_path)
-            self._cursor = self._connection.cursor()
+            self._pool = connection_pool(db_path, in_memory, **settings)
+            self._cache = collections.OrderedDict()
+            self._cache_size = cache_size
+            self._cache_lock = threading.Lock()
+
+        @property
+        def _cursor(self):
+            return self._traced(self._pool.connection()).cursor()
 
         def __repr__(self):
             return self.name
 
         def __getitem__(self, link_name):
-            select_query = self._select + ' where name="{}"'.format(link_name)
-            return self._cursor.execute(select_query).fetchall()[0][0]
-        
+            cache = self._cache
+            with self._cache_lock:
+                if link_name in cache:
+                    DT = cache.pop(link_name)
+                    cache[link_name] = DT
+                    return DT
+            DT = unpack_DT(self._fetch(link_name, 'DT'))
+            if self._cache_size > 0:
+                with self._cache_lock:
+                    cache[link_name] = DT
+                    if len(cache) > self._cache_size:
+                        cache.popitem(last=False)
+            return DT
+
+        def _fetch(self, link_name, column):
+            cursor, row = self._cursor, None
+            if self._data_table:
+                id = name_offsets_of(cursor, self._pool.db_path,
+                                     self._data_table).id(link_name)
+                if id is not None:
+                    row = cursor.execute(self._select_by_id % column,
+                                         (id,)).fetchone()
+                    if row is not None and row[1] != link_name:
+                        row = None
+            if row is None:
+                row = cursor.execute(self._select % column,
+                                     (link_name,)).fetchone()
+            if row is None:
+                raise LinkNotFoundError(
+                    'The link %s was not found.' % link_name)
+            return row[0]
+
+        def DT_code(self, link_name):
+            """
+            The numerical DT code of a link, as a list of tuples of ints
+            like that of M.DT_code(), read from the DT_ints column with
+            no parsing of the alphabetical DT code.  To get those of
+            many links, use iter_raw(['name', 'DT_ints']).
+            """
+            return unpack_DT_ints(self._fetch(link_name, 'DT_ints'))
+
+        def aget(self, link_name):
+            """
+            Awaitable version of self[link_name], which runs in the
+            thread pool of the aio module.
+            """
+            from . import aio
+            return aio.aget(self, link_name)
+
+        def aget_many(self, names):
+            """
+            Awaitable version of self.get_many(names).
+            """
+            from . import aio
+            return aio.aget_many(self, names)
+
+        def get_many(self, names, chunk_size=500):
+            """
+            Look up the DT codes of many links with one query for each
+            chunk_size names.  Returns a dictionary mapping each of the
+            names which is in the table to its DT code.
+            """
+            names = list(set(names))
+            result = {}
+            cursor = self._cursor
+            for start in range(0, len(names), chunk_size):
+                chunk = names[start:start + chunk_size]
+                query = 'select name, DT from %s where name in (%s)' % (
+                    self._table, ', '.join('?' for name in chunk))
+                result.update((name, unpack_DT(DT))
+                              for name, DT in cursor.execute(query, chunk))
+            return result
+
+        def name_for_DT(self, DT):
+            """
+            The name of the link with the given DT code, which can take
+            any of the forms accepted by DT_key.  Since the tables list
+            links up to mirror image, the DT code of a mirror image
+            gives the same name, and so does the DT code of any
+            traversal of the diagram in the table, such as the one of
+            a spherogram Link made from it.  Raises a LinkNotFoundError
+            if no link in the table has this DT code, which includes DT
+            codes that DT_key rejects, such as those of links with more
+            than 26 crossings.
+            """
+            try:
+                key = DT_key(DT)
+            except ValueError:
+                row = None
+            else:
+                row = self._cursor.execute(self._select_by_DT_key,
+                                           (key,)).fetchone()
+            if row is None:
+                raise LinkNotFoundError(
+                    'No link with the DT code %s was found.' % (DT,))
+            return row[0]
+
+        def names_for_DTs(self, DTs, chunk_size=500):
+            """
+            Look up the names of the links with many DT codes, with one
+            query for each chunk_size distinct codes.  Returns the list
+            of the names in the same order, with None for the codes
+            which are not in the table, or which DT_key rejects.
+            """
+            keys = []
+            for DT in DTs:
+                try:
+                    keys.append(DT_key(DT))
+                except ValueError:
+                    keys.append(None)
+            distinct = list(set(keys) - {None})
+            names = {}
+            cursor = self._cursor
+            for start in range(0, len(distinct), chunk_size):
+                chunk = distinct[start:start + chunk_size]
+                # In descending order, so the first name of each key wins.
+                query = ('select DT_key, name from %s where DT_key in (%s) '
+                         'order by id desc' % (
+                             self._table, ', '.join('?' for key in chunk)))
+                names.update(cursor.execute(query, chunk))
+            return [names.get(key) for key in keys]
+
+        def iter_raw(self, columns=('name', 'DT'), batch_size=1000,
+                     named=False):
+            """
+            Generator yielding the given columns of all rows of the
+            table, as tuples or, if named is set, as namedtuples.
+            """
+            cursor = self._cursor
+            schema = [row[1] for row in cursor.execute(
+                "pragma table_info('%s')" % self._table)]
+            for column in columns:
+                if column not in schema:
+                    raise ValueError('There is no column %s.' % column)
+            query = 'select %s from %s order by id' % (
+                ', '.join(columns), self._table)
+            return raw_rows(cursor, query, columns, batch_size, named)
+
         def __len__(self):
-            length_query = 'select count(*) from ' + self._table
+            if self._data_table:
+                length_query = ("select value from metadata where "
+                                "tablename='%s' and key='rows'" %
+                                self._data_table)
+            else:
+                length_query = 'select count(*) from ' + self._table
             return self._cursor.execute(length_query).fetchone()[0]
 
 
     HTLinkDTcodesExtended = DTCodeTable(name='HTLinkDTcodesExtended',
                                         table='HT_links_view',
-                                        db_path=database_path)
+                                        db_path=database_path,
+                                        data_table='HT_links')
     return [HTLinkDTcodesExtended]
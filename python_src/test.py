@@ -11,6 +11,28 @@ doctests are run by snappy.
 'oaobdegahjckmfniol.010100100001110'
 >>> str(HT['K15n168030'])
 'oaoeimKLjncbaoDhgf.010110110000100'
+>>> sorted(HT.get_many(['K15a1', 'L12n345', 'garbage']))
+['K15a1', 'L12n345']
+>>> try:
+...     HT['garbage']
+... except KeyError:
+...     print('not found')
+not found
+>>> HT.DT_code('L5a1')
+[(6, 8), (2, 10, 4)]
+>>> next(HT.iter_raw(['name', 'DT_ints']))
+('K3a1', [(4, 6, 2)])
+>>> HT.name_for_DT('cacbca.001'), HT.name_for_DT([(-4, -6, -2)])
+('K3a1', 'K3a1')
+>>> HT.names_for_DTs(['lbbjceGkjHILFadb', 'dadbcda', 'cacBCA'])
+['L12n345', 'K4a1', 'K3a1']
+>>> from spherogram import Link
+>>> HT.name_for_DT(Link('L5a1')), HT.name_for_DT(Link('DT:' + HT['L12n345']))
+('L5a1', 'L12n345')
+>>> with HT.instrumented() as stats:
+...     DTs = HT.get_many(['K14n1', 'K14n2'])
+>>> stats.statements, stats.rows
+(1, 2)
 """
 
 from .database import get_DT_tables
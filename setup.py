@@ -6,7 +6,7 @@ import re, sys, subprocess, os, shutil, glob, sysconfig
 from setuptools import setup, Command
 from setuptools.command.build_py import build_py
 
-sqlite_files = ['15_knots.sqlite']
+sqlite_files = ['15_knots.sqlite', '*.npy', '*.bloom']
 
 def check_call(args):
     try:
@@ -20,7 +20,7 @@ def check_call(args):
 class Clean(Command):
     """
     Removes the usual build/dist/egg-info directories as well as the
-    sqlite database files.
+    sqlite database files and their .npy arrays and Bloom filters.
     """
     user_options = []
     def initialize_options(self):
@@ -31,7 +31,9 @@ class Clean(Command):
         for dir in ['build', 'dist'] + glob.glob('*.egg-info'):
             if os.path.exists(dir):
                 shutil.rmtree(dir)
-        for file in glob.glob('manifold_src/*.sqlite'):
+        for file in (glob.glob('manifold_src/*.sqlite') + glob.glob('manifold_src/*.npy')
+                     + glob.glob('manifold_src/*.bloom')
+                     + glob.glob('manifold_src/*.sqlite.build')):
             os.remove(file)
 
 
@@ -47,7 +49,7 @@ class BuildPy(build_py):
         # When there are no csv files, we are in an sdist tarball
         if len(csv_source_files) != 0:
             if self.force:
-                for file in glob.glob('*.sqlite'):
+                for file in glob.glob('*.sqlite') + glob.glob('*.npy') + glob.glob('*.bloom'):
                     os.remove(file)
             print('Rebuilding stale sqlite databases from csv sources if necessary...')
             check_call([sys.executable, 'make_sqlite_db.py'])
@@ -0,0 +1,503 @@
+"""
+Benchmarks of the queries behind HTLinkExteriors and the DT code
+tables, made directly with sqlite3 so that neither snappy nor an
+installed snappy_15_knots is needed.  Each scenario issues the same
+statements as the corresponding table operation:
+
+  get_by_index     HTLinkExteriors[i], now a primary key fetch
+  get_by_offset    HTLinkExteriors[i] as snappy does it, with an offset
+  random_sample    HTLinkExteriors.random()
+  identify         M.identify(), which looks up the hash of M
+  identify_many    HTLinkExteriors.identify_many(manifolds), one query
+  identify_mixed   identify for a mix of hits and misses, each queried
+  identify_bloom   the same, with misses rejected by the Bloom filter
+  iterate          iterating over HTLinkExteriors[i:i+n]
+  scan             reading the name, triangulation and DT of every row
+  get_by_name      HTLinkExteriors['K14n1234']
+  DT_lookup        HTLinkDTcodes['K14n1234']
+  DT_get_many      HTLinkDTcodes.get_many(names)
+  DT_scan          finding the name of a DT code by scanning the DT column
+  DT_reverse       HTLinkDTcodes.name_for_DT(DT), using the DT_key index
+  DT_reverse_many  HTLinkDTcodes.names_for_DTs(DTs)
+  DT_parse         numerical DT codes of n links parsed from the DT column
+  DT_ints          the same read from the DT_ints column, as DT_code does
+  filtered_count   len(HTLinkExteriors(crossings=14, alternating=False))
+  volume_count     len(HTLinkExteriors[10.0:15.0])
+  build            running manifold_src/make_sqlite_db.py from scratch
+
+The environment section of the results includes the false positive
+rate of the Bloom filter, measured with 100000 hashes not in the
+table; it is built for 1%.  Note that with the database in the page
+cache, a miss in the hash index costs sqlite about as much as the
+Bloom filter check costs Python, so identify_bloom is no faster than
+identify_mixed here; the saving in HTLinkExteriors.identify comes from
+also skipping the volume query of siblings and the Manifolds it builds.
+
+It also includes the storage format of the triangulation, isosig and
+DT columns, text or compact, the size of the database file and the
+bytes held in each of those columns.  The iterate and scan scenarios decode
+compact values as the tables do, so comparing a database built with
+SNAPPY_15_KNOTS_COMPACT=1 with a baseline saved for a text one shows
+both the size reduction and its effect on iteration.  Older databases
+can be benchmarked too: the scenarios needing columns they lack are
+skipped.
+
+For example, from the top directory of the repository:
+
+  python validation/benchmark.py --save-baseline
+  ... change an index or the schema, and rebuild ...
+  python validation/benchmark.py
+
+The second run compares the median time of each scenario with the
+saved baseline and exits with status 1 if any is slower by more than
+the threshold, 25% by default.  Results are only comparable on the
+same machine and database, which is why no baseline is kept in the
+repository.  The build scenario takes minutes and is only run with
+--build.
+"""
+
+from __future__ import print_function
+import os, sys, time, json, random, sqlite3, platform, argparse
+import shutil, tempfile, subprocess, struct, hashlib
+
+validation_dir = os.path.dirname(os.path.abspath(__file__))
+manifold_src = os.path.join(os.path.dirname(validation_dir), 'manifold_src')
+default_db = os.path.join(manifold_src, '15_knots.sqlite')
+default_baseline = os.path.join(validation_dir, 'benchmark_baseline.json')
+sys.path.insert(0, manifold_src)
+from make_sqlite_db import bloom_bits, bloom_header, bloom_path, DT_key
+from make_sqlite_db import unpack_isosig, unpack_DT, unpack_DT_ints
+
+select = 'select name, triangulation, DT from HT_links_view '
+
+def indices(n, length):
+    """
+    n indices spread over the table: powers of 13 mod the length.
+    """
+    return [13**i % length for i in range(1, n + 1)]
+
+def sample_rows(connection, column, n, seed=0):
+    """
+    The values of a column in n rows chosen at random.
+    """
+    min_id, max_id = connection.execute(
+        'select min(id), max(id) from HT_links').fetchone()
+    rng = random.Random(seed)
+    ids = [rng.randint(min_id, max_id) for _ in range(n)]
+    query = 'select %s from HT_links where id = ?' % column
+    return [connection.execute(query, (id,)).fetchone()[0] for id in ids]
+
+def get_by_index(connection, n):
+    min_id, length = connection.execute(
+        'select min(id), count(*) from HT_links').fetchone()
+    for d in indices(n, length):
+        connection.execute(select + 'where id = ?', (min_id + d,)).fetchall()
+
+def get_by_offset(connection, n):
+    length = connection.execute('select count(*) from HT_links').fetchone()[0]
+    for d in indices(n, length):
+        connection.execute(
+            select + 'order by id limit 1 offset %d' % d).fetchall()
+
+def random_sample(connection, n):
+    min_id, max_id = connection.execute(
+        'select min(id), max(id) from HT_links').fetchone()
+    rng = random.Random(0)
+    for _ in range(n):
+        id = rng.randint(min_id, max_id)
+        connection.execute(select + 'where id = ?', (id,)).fetchall()
+
+def identify(connection, n, hashes=None):
+    for hash in hashes:
+        connection.execute(select + 'where hash = ?', (hash,)).fetchall()
+
+def identify_many(connection, n, hashes=None):
+    connection.execute(
+        select + 'where hash in (select value from json_each(?)) order by id',
+        (json.dumps(hashes),)).fetchall()
+
+def load_bloom(db_path):
+    """
+    The Bloom filter of the hashes written next to the database, as
+    (bits, num_bits, num_hashes), or None if there is none.
+    """
+    path = os.path.join(os.path.dirname(db_path), bloom_path('HT_links', 'hash'))
+    if not os.path.exists(path):
+        return None
+    with open(path, 'rb') as input:
+        data = input.read()
+    magic, num_bits, num_hashes = struct.unpack_from(bloom_header, data)
+    return data[struct.calcsize(bloom_header):], num_bits, num_hashes
+
+def in_bloom(bloom, key):
+    bits, num_bits, num_hashes = bloom
+    return all(bits[bit >> 3] >> (bit & 7) & 1
+               for bit in bloom_bits(key, num_bits, num_hashes))
+
+def missing_hashes(n, seed=0):
+    """
+    n hashes of the same form as those in the table, which are almost
+    certainly not in it.
+    """
+    rng = random.Random(seed)
+    return [hashlib.md5(str(rng.random()).encode()).hexdigest()
+            for _ in range(n)]
+
+def mixed_hashes(connection, n):
+    """
+    n hashes, half from the table and half not, in random order.
+    """
+    hashes = sample_rows(connection, 'hash', n // 2) + missing_hashes(n - n // 2)
+    random.Random(1).shuffle(hashes)
+    return hashes
+
+def identify_mixed(connection, n, hashes=None, bloom=None):
+    for hash in hashes:
+        connection.execute(select + 'where hash = ?', (hash,)).fetchall()
+
+def identify_bloom(connection, n, hashes=None, bloom=None):
+    for hash in hashes:
+        if in_bloom(bloom, hash):
+            connection.execute(select + 'where hash = ?', (hash,)).fetchall()
+
+def bloom_false_positive_rate(db_path, trials=100000):
+    bloom = load_bloom(db_path)
+    if bloom is None:
+        return None
+    hits = sum(in_bloom(bloom, hash) for hash in missing_hashes(trials, seed=2))
+    return hits / float(trials)
+
+def iterate(connection, n):
+    min_id, length = connection.execute(
+        'select min(id), count(*) from HT_links').fetchone()
+    start = min_id + length // 2
+    rows = connection.execute(select + 'where id >= ? and id < ? order by id',
+                              (start, start + n)).fetchall()
+    rows = [(name, unpack_isosig(triangulation), unpack_DT(DT))
+            for name, triangulation, DT in rows]
+    assert len(rows) == min(n, length - length // 2)
+
+def scan(connection, n, batch_size=1000):
+    cursor = connection.execute(select + 'order by id')
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        rows = [(name, unpack_isosig(triangulation), unpack_DT(DT))
+                for name, triangulation, DT in rows]
+
+def get_by_name(connection, n):
+    for d in indices(n, 10000):
+        for name in ('K14n%d' % d, 'L14n%d' % d):
+            connection.execute(select + 'where name = ?', (name,)).fetchall()
+
+def DT_lookup(connection, n, names=None):
+    for name in names:
+        connection.execute('select DT from HT_links where name = ?',
+                           (name,)).fetchone()
+
+def DT_get_many(connection, n, names=None, chunk_size=500):
+    found = {}
+    for i in range(0, len(names), chunk_size):
+        chunk = names[i:i + chunk_size]
+        query = ('select name, DT from HT_links where name in (%s)'
+                 % ','.join('?' * len(chunk)))
+        found.update(connection.execute(query, chunk).fetchall())
+    return found
+
+def DT_scan(connection, n, DTs=None):
+    for DT in DTs:
+        connection.execute('select name from HT_links where DT = ?',
+                           (DT,)).fetchone()
+
+def DT_reverse(connection, n, DTs=None):
+    for DT in DTs:
+        connection.execute(
+            'select name from HT_links where DT_key = ? order by id limit 1',
+            (DT_key(DT),)).fetchone()
+
+def DT_reverse_many(connection, n, DTs=None, chunk_size=500):
+    keys = list(set(DT_key(DT) for DT in DTs))
+    found = {}
+    for i in range(0, len(keys), chunk_size):
+        chunk = keys[i:i + chunk_size]
+        query = ('select DT_key, name from HT_links where DT_key in (%s) '
+                 'order by id desc' % ','.join('?' * len(chunk)))
+        found.update(connection.execute(query, chunk).fetchall())
+    return found
+
+def parse_DT(DT):
+    """
+    The numerical DT code of an alphabetical one, as spherogram's
+    DTcodec.convert_alpha finds it.
+    """
+    code = DT.split('.')[0]
+    num_components = ord(code[1]) - 96
+    entries = [2 * (ord(letter) - 96) if letter.islower()
+               else -2 * (ord(letter) - 64)
+               for letter in code[2 + num_components:]]
+    result, start = [], 0
+    for letter in code[2:2 + num_components]:
+        length = ord(letter) - 96
+        result.append(tuple(entries[start:start + length]))
+        start += length
+    return result
+
+def DT_parse(connection, n):
+    rows = connection.execute(
+        'select name, DT from HT_links where id <= ?', (n,)).fetchall()
+    return [(name, parse_DT(unpack_DT(DT))) for name, DT in rows]
+
+def DT_ints(connection, n):
+    rows = connection.execute(
+        'select name, DT_ints from HT_links where id <= ?', (n,)).fetchall()
+    return [(name, unpack_DT_ints(DT)) for name, DT in rows]
+
+def filtered_count(connection, n):
+    for _ in range(n):
+        for crossings in range(10, 16):
+            for alternating in (0, 1):
+                connection.execute(
+                    'select count(*) from HT_links where crossings = ? '
+                    'and alternating = ? and components = 1',
+                    (crossings, alternating)).fetchone()
+
+def volume_count(connection, n):
+    for i in range(n):
+        start = 2.0 + 0.5 * i
+        connection.execute(
+            'select count(*) from HT_links where volume >= ? and volume < ?',
+            (start, start + 5.0)).fetchone()
+
+# (name, function, n, keyword arguments needing the database)
+scenarios = [
+    ('get_by_index', get_by_index, 200, None),
+    ('get_by_offset', get_by_offset, 20, None),
+    ('random_sample', random_sample, 1000, None),
+    ('identify', identify, 1000, 'hashes'),
+    ('identify_many', identify_many, 1000, 'hashes'),
+    ('identify_mixed', identify_mixed, 1000, 'mixed'),
+    ('identify_bloom', identify_bloom, 1000, 'mixed'),
+    ('iterate', iterate, 10000, None),
+    ('scan', scan, 1, None),
+    ('get_by_name', get_by_name, 1000, None),
+    ('DT_lookup', DT_lookup, 1000, 'names'),
+    ('DT_get_many', DT_get_many, 10000, 'names'),
+    ('DT_scan', DT_scan, 10, 'DTs'),
+    ('DT_reverse', DT_reverse, 1000, 'DTs'),
+    ('DT_reverse_many', DT_reverse_many, 10000, 'DTs'),
+    ('DT_parse', DT_parse, 100000, None),
+    ('DT_ints', DT_ints, 100000, None),
+    ('filtered_count', filtered_count, 10, None),
+    ('volume_count', volume_count, 20, None),
+]
+
+# The columns of HT_links, beyond those of the original schema, which
+# each scenario needs; scenarios are skipped on older databases which
+# lack them.
+required_columns = {
+    'DT_reverse': ['DT_key'],
+    'DT_reverse_many': ['DT_key'],
+    'DT_ints': ['DT_ints'],
+    'filtered_count': ['crossings', 'alternating', 'components'],
+}
+
+def table_columns(connection, table):
+    return [row[1] for row in connection.execute(
+        "pragma table_info('%s')" % table)]
+
+def has_table(connection, table):
+    return connection.execute(
+        "select count(*) from sqlite_master where type='table' and name=?",
+        (table,)).fetchone()[0] > 0
+
+def connect(db_path, pragmas):
+    uri = 'file:' + db_path + '?mode=ro'
+    connection = sqlite3.connect(uri, uri=True)
+    for pragma in pragmas:
+        connection.execute('pragma ' + pragma)
+    return connection
+
+def measure(function, args, kwargs, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2],
+            'mean': sum(times) / len(times), 'runs': times}
+
+def run_queries(db_path, pragmas, repeat, only=None):
+    connection = connect(db_path, pragmas)
+    columns = table_columns(connection, 'HT_links')
+    results = {}
+    for name, function, n, data in scenarios:
+        if only and name not in only:
+            continue
+        missing = [column for column in required_columns.get(name, [])
+                   if column not in columns]
+        if missing:
+            print('Skipping %s: HT_links has no %s column.' % (
+                name, ', '.join(missing)))
+            continue
+        kwargs = {}
+        if data == 'hashes':
+            kwargs['hashes'] = sample_rows(connection, 'hash', n)
+        elif data == 'names':
+            kwargs['names'] = sample_rows(connection, 'name', n)
+        elif data == 'DTs':
+            kwargs['DTs'] = sample_rows(connection, 'DT', n)
+        elif data == 'mixed':
+            kwargs['hashes'] = mixed_hashes(connection, n)
+            kwargs['bloom'] = load_bloom(db_path)
+            if function is identify_bloom and kwargs['bloom'] is None:
+                print('Skipping %s: there is no Bloom filter.' % name)
+                continue
+        result = measure(function, (connection, n), kwargs, repeat)
+        result['n'] = n
+        results[name] = result
+    connection.close()
+    return results
+
+def run_build(repeat):
+    """
+    Time make_sqlite_db.py building the database from scratch in a
+    temporary directory.
+    """
+    sources = os.path.join(manifold_src, 'original_manifold_sources')
+    if not os.path.isdir(sources):
+        print('Skipping the build: there are no csv sources.')
+        return None
+    times = []
+    for _ in range(repeat):
+        work = tempfile.mkdtemp()
+        try:
+            shutil.copy(os.path.join(manifold_src, 'make_sqlite_db.py'), work)
+            os.symlink(sources, os.path.join(work, 'original_manifold_sources'))
+            start = time.perf_counter()
+            subprocess.check_call([sys.executable, 'make_sqlite_db.py'],
+                                  cwd=work, stdout=subprocess.DEVNULL)
+            times.append(time.perf_counter() - start)
+        finally:
+            shutil.rmtree(work)
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2],
+            'mean': sum(times) / len(times), 'runs': times, 'n': 1}
+
+def environment(db_path, pragmas):
+    connection = connect(db_path, [])
+    rows = connection.execute('select count(*) from HT_links').fetchone()[0]
+    storage = None
+    if has_table(connection, 'metadata'):
+        storage = connection.execute(
+            "select value from metadata where tablename='HT_links' and "
+            "key='storage'").fetchone()
+    # Older databases have no isosig column, nor do those built
+    # without canonical isosigs.
+    columns = [column for column in ['triangulation', 'isosig', 'DT']
+               if column in table_columns(connection, 'HT_links')]
+    column_bytes = dict(zip(columns, connection.execute(
+        'select %s from HT_links' % ', '.join(
+            'sum(length(%s))' % column for column in columns)).fetchone()))
+    connection.close()
+    return {'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'machine': platform.machine(),
+            'database': db_path,
+            'database_bytes': os.path.getsize(db_path),
+            'storage': storage[0] if storage else 'text',
+            'column_bytes': column_bytes,
+            'rows': rows,
+            'bloom_false_positive_rate': bloom_false_positive_rate(db_path),
+            'pragmas': pragmas,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+def compare(results, baseline, threshold):
+    """
+    Print the ratio of each median to the baseline's, and return the
+    names of the scenarios slower by more than the threshold.
+    """
+    regressions = []
+    new, old = results['environment'], baseline['environment']
+    sizes = [('database', new['database_bytes'], old.get('database_bytes'))]
+    for column, size in sorted(new.get('column_bytes', {}).items()):
+        sizes.append((column, size, old.get('column_bytes', {}).get(column)))
+    print('%-16s %12s %12s %8s' % ('size', 'bytes', 'baseline', 'ratio'))
+    for name, size, old_size in sizes:
+        if old_size:
+            print('%-16s %12d %12d %8.2f' % (name, size, old_size,
+                                             size / old_size))
+        else:
+            print('%-16s %12d %12s %8s' % (name, size, '-', '-'))
+    print()
+    print('%-16s %12s %12s %8s' % ('scenario', 'median (s)', 'baseline', 'ratio'))
+    for name, result in sorted(results['results'].items()):
+        old = baseline['results'].get(name)
+        if old is None:
+            print('%-16s %12.6f %12s %8s' % (name, result['median'], '-', '-'))
+            continue
+        ratio = result['median'] / old['median']
+        flag = ''
+        if ratio > 1 + threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print('%-16s %12.6f %12.6f %8.2f%s' % (
+            name, result['median'], old['median'], ratio, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark the sqlite queries behind snappy_15_knots.')
+    parser.add_argument('--db', default=default_db,
+                        help='the database to read (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='runs of each scenario; the median is compared')
+    parser.add_argument('--only', nargs='*', metavar='SCENARIO',
+                        help='run only these scenarios')
+    parser.add_argument('--pragma', action='append', default=[],
+                        metavar='NAME=VALUE',
+                        help='a pragma for the connection, e.g. mmap_size=0')
+    parser.add_argument('--build', action='store_true',
+                        help='also time building the database from the csv files')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--baseline', default=default_baseline,
+                        help='the baseline to compare with (default: %(default)s)')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='save the results as the baseline')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='the allowed slowdown, as a fraction of the baseline')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.db):
+        parser.error('There is no database at %s; run make_sqlite_db.py.' % args.db)
+    results = {'environment': environment(args.db, args.pragma),
+               'results': run_queries(args.db, args.pragma, args.repeat,
+                                      args.only)}
+    if args.build:
+        build = run_build(1 if args.repeat < 3 else 3)
+        if build is not None:
+            results['results']['build'] = build
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+        print('Saved the baseline to %s.' % args.baseline)
+    if not args.output and not args.save_baseline:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as input:
+            baseline = json.load(input)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print('Slower than the baseline by more than %d%%: %s' % (
+                100 * args.threshold, ', '.join(regressions)))
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
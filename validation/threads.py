@@ -0,0 +1,63 @@
+"""
+Stress test for using the tables from many threads at once.  Each
+thread reads through its own connection from the ConnectionPool, so
+the lookups below must all succeed, and the throughput shows how well
+the sqlite reads scale with the number of threads.
+
+Run as "python threads.py".  The DT lookups do not need snappy; the
+HTLinkExteriors lookups are skipped if snappy cannot be imported.
+
+On a single-core Linux machine, Python 3.11, the rates stay flat as
+threads are added (about 37000 DT lookups and 1500 HTLinkExteriors[n]
+per second); the point there is that nothing fails.  Parallel
+speedups need as many cores as threads, and the HTLinkExteriors
+figures are limited by building the Manifolds, which holds the GIL.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+import snappy_15_knots
+
+DT_table = snappy_15_knots.get_DT_tables()[0]
+DT_table._cache_size = 0
+
+
+def DT_lookups(n):
+    for i in range(1, n):
+        d = 13**i % 10000
+        for name in ['K14n%d' % d, 'L14n%d' % d]:
+            try:
+                DT_table[name]
+            except KeyError:
+                pass
+
+
+def index_lookups(n):
+    for i in range(1, n):
+        HT[13**i % 100000]
+
+
+def throughput(func, threads, jobs=64, n=500):
+    """
+    Calls per second when running the given number of jobs, each doing
+    func(n), on a pool of threads.
+    """
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(func, [n] * jobs))
+    return jobs * (n - 1) / (time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    tests = [('DT lookups', DT_lookups)]
+    try:
+        import snappy
+        HT = snappy.HTLinkExteriors
+        len(HT)
+        tests.append(('HTLinkExteriors[n]', index_lookups))
+    except ImportError:
+        print('snappy not found, skipping HTLinkExteriors')
+    for label, func in tests:
+        for threads in [1, 2, 4, 8]:
+            print('%-20s %d threads: %9.0f per second' % (
+                label, threads, throughput(func, threads)))